@@ -1,6 +1,6 @@
 from machine import Pin, I2C
 from struct import unpack as unp
-from time import sleep_ms
+from time import sleep_ms, ticks_ms, ticks_add, ticks_diff
 
 # SHT20 default address
 SHT20_I2CADDR = 64
@@ -12,6 +12,21 @@ READ_USER_REG = b'\xe7'
 WRITE_USER_REG = b'\xe6'
 SOFT_RESET = b'\xfe'
 
+# Measurement kinds, see start_temperature() and start_relative_humidity()
+TEMPERATURE = 'temperature'
+RELATIVE_HUMIDITY = 'relative_humidity'
+
+# Maximum conversion times in ms (T, RH) per resolution, from the datasheet.
+# The resolution is given by bits 7 and 0 of the user register.
+_CONVERSION_TIMES = {
+    0x00: (85, 29),  # T 14 bit, RH 12 bit
+    0x01: (22, 4),   # T 12 bit, RH 8 bit
+    0x80: (43, 9),   # T 13 bit, RH 10 bit
+    0x81: (11, 15),  # T 11 bit, RH 11 bit
+}
+_RESOLUTION_MASK = 0x81
+_GRACE_MS = 50  # After the conversion time, before giving up on the sensor
+
 
 class SHT20(object):
 
@@ -22,18 +37,69 @@ class SHT20(object):
         pin_d = Pin(sda_pin)
         self._bus = I2C(scl=pin_c, sda=pin_d, freq=clk_freq)
 
+        # The measurement in progress, see poll_result()
+        self.measuring = None
+        self._conversion_times = None  # Read from the user register at the first measurement
+        self._deadline = 0
+
     def get_temperature(self):
-        self._bus.writeto(self._address, TRI_T_MEASURE_NO_HOLD)
-        sleep_ms(150)
-        origin_data = self._bus.readfrom(self._address, 2)
-        origin_value = unp('>h', origin_data)[0]
-        value = -46.85 + 175.72 * (origin_value / 65536)
-        return value
+        self.start_temperature()
+        return self._wait_result()
 
     def get_relative_humidity(self):
-        self._bus.writeto(self._address, TRI_RH_MEASURE_NO_HOLD)
-        sleep_ms(150)
-        origin_data = self._bus.readfrom(self._address, 2)
+        self.start_relative_humidity()
+        return self._wait_result()
+
+    def start_temperature(self):
+        # Start a temperature measurement, get the value with poll_result()
+        self._start(TRI_T_MEASURE_NO_HOLD, TEMPERATURE, 0)
+
+    def start_relative_humidity(self):
+        # Start a humidity measurement, get the value with poll_result()
+        self._start(TRI_RH_MEASURE_NO_HOLD, RELATIVE_HUMIDITY, 1)
+
+    def poll_result(self):
+        # The value of the started measurement, or None while the sensor is still converting.
+        # The bus is not used before the conversion time of the resolution has passed; after
+        # that the sensor answers the read with a NACK until the result is ready.
+        if self.measuring is None:
+            raise ValueError('No measurement started')
+        late = ticks_diff(ticks_ms(), self._deadline)
+        if late < 0:
+            return None
+
+        try:
+            origin_data = self._bus.readfrom(self._address, 2)
+        except OSError:  # NACK, still measuring
+            if late > _GRACE_MS:
+                self.measuring = None
+                raise OSError('The SHT20 did not finish the measurement')
+            return None
+
+        kind = self.measuring
+        self.measuring = None
+        if kind == TEMPERATURE:
+            origin_value = unp('>h', origin_data)[0]
+            return -46.85 + 175.72 * (origin_value / 65536)
         origin_value = unp('>H', origin_data)[0]
-        value = -6 + 125 * (origin_value / 65536)
-        return value
+        return -6 + 125 * (origin_value / 65536)
+
+    def _start(self, command, kind, index):
+        if self._conversion_times is None:
+            self._bus.writeto(self._address, READ_USER_REG)
+            user_register = self._bus.readfrom(self._address, 1)[0]
+            self._conversion_times = _CONVERSION_TIMES[user_register & _RESOLUTION_MASK]
+
+        self._bus.writeto(self._address, command)
+        self.measuring = kind
+        self._deadline = ticks_add(ticks_ms(), self._conversion_times[index])
+
+    def _wait_result(self):
+        delay = ticks_diff(self._deadline, ticks_ms())
+        if delay > 0:
+            sleep_ms(delay)
+        while True:
+            value = self.poll_result()
+            if value is not None:
+                return value
+            sleep_ms(1)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+# Benchmark of the heap use of a steady-state poll with read_registers_into() and
+# PreparedRead.execute_into(), against a minimalmodbus_slave.Slave in memory.
+#
+# On MicroPython the heap is measured with gc.mem_alloc() and the garbage collector
+# disabled, so every byte allocated by a poll is counted, and any allocation fails.
+# CPython allocates for ints anyway, so there tracemalloc measures the memory still held
+# after the polls. The counters and timestamps stored in attributes hold a few ints, but
+# anything kept per poll adds at least one object (16 bytes or more) per poll; the
+# benchmark fails at an average of 1 byte per poll. Exits with status 1 on failure.
+#
+#   micropython bench_alloc.py
+#   python3 bench_alloc.py
+
+import sys
+from array import array
+
+from minimalmodbus import Instrument
+from minimalmodbus_slave import Slave
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # MicroPython, gc.mem_alloc() is used instead
+
+import gc
+
+POLLS = 1000
+WARMUP_POLLS = 100
+NUMBER_OF_REGISTERS = 10
+SLAVEADDRESS = 1
+
+
+class SlaveTransport():
+#    """In-memory transport to a Slave, which itself does not allocate.
+
+#    LoopbackTransport copies the frames into new bytes objects, which would be counted
+#    as allocations of the poll. Here the Slave answers in its TX buffer, and readinto()
+#    copies the reply from there.
+#    """
+
+    def __init__(self, slave):
+        self.slave = slave
+        self._length = 0
+        self._position = 0
+
+    def write(self, buffer):
+        self._length = self.slave.handle(buffer, len(buffer))
+        self._position = 0
+        return len(buffer)
+
+    def any(self):
+        return self._length - self._position
+
+    def readinto(self, buffer, nbytes=None):
+        if nbytes is None:
+            nbytes = len(buffer)
+        nbytes = min(nbytes, len(buffer), self._length - self._position)
+        if nbytes <= 0:
+            return None
+        tx = self.slave._txbuf
+        position = self._position
+        for i in range(nbytes):
+            buffer[i] = tx[position + i]
+        self._position = position + nbytes
+        return nbytes
+
+    def read(self, nbytes):
+        # Only used to drain stale input, which does not happen here
+        size = min(nbytes, self._length - self._position)
+        data = bytes(self.slave._txbuf[self._position:self._position + size])
+        self._position += size
+        return data
+
+
+def measure(poll):
+    # Heap growth in bytes over POLLS calls of poll(), after the warm-up polls
+    if tracemalloc is None:
+        for _ in range(WARMUP_POLLS):
+            poll()
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        for _ in range(POLLS):
+            poll()
+        growth = gc.mem_alloc() - before
+        gc.enable()
+        return growth
+
+    # Started before the warm-up, which fills the caches of the interpreter and of tracemalloc
+    tracemalloc.start()
+    for _ in range(WARMUP_POLLS):
+        poll()
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(POLLS):
+        poll()
+    gc.collect()
+    growth = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return growth
+
+
+def main():
+    slave = Slave(SLAVEADDRESS, holding_registers=NUMBER_OF_REGISTERS)
+    for i in range(NUMBER_OF_REGISTERS):
+        slave.holding_registers[i] = 1000 + i
+
+    # The highest baudrate gives the shortest silent period, so the benchmark runs quickly
+    device = Instrument('bench', SLAVEADDRESS, transport=SlaveTransport(slave), baudrate=115200, preallocate=True)
+    values = array('H', [0] * NUMBER_OF_REGISTERS)
+    prepared = device.prepare_read(0, NUMBER_OF_REGISTERS)
+
+    def read_into():
+        device.read_registers_into(0, values)
+
+    def execute_into():
+        prepared.execute_into(values)
+
+    if tracemalloc is None:
+        method, limit = 'gc.mem_alloc()', 0
+    else:
+        method, limit = 'tracemalloc', POLLS - 1
+    failed = False
+    for name, poll in (('read_registers_into', read_into), ('PreparedRead.execute_into', execute_into)):
+        growth = measure(poll)
+        print('{}: {} polls, heap growth {} bytes, {:.3f} bytes per poll ({})'.format( \
+            name, POLLS, growth, growth / POLLS, method))
+        if growth > limit:
+            failed = True
+
+    if values[NUMBER_OF_REGISTERS - 1] != 1000 + NUMBER_OF_REGISTERS - 1:
+        print('Wrong register values: {}'.format(list(values)))
+        failed = True
+
+    if failed:
+        print('FAILED: the heap grew per poll')
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
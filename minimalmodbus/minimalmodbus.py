@@ -31,18 +31,93 @@
 
 
 import os
-from pyb import UART
 import struct
 import sys
 import time
+from array import array
+
+try:
+    from pyb import UART
+except ImportError:
+    UART = None  # Not on a pyboard, use SerialTransport or LoopbackTransport
+
+try:
+    import _thread
+except ImportError:
+    _thread = None  # No threads, so no locking is needed
+
+# Millisecond and microsecond ticks, with a fallback for CPython.
+# ticks_diff() and ticks_add() work for both.
+if hasattr(time, 'ticks_ms'):
+    _ticks_ms = time.ticks_ms
+    _ticks_us = time.ticks_us
+    _ticks_diff = time.ticks_diff
+    _ticks_add = time.ticks_add
+    _sleep_ms = time.sleep_ms
+    _sleep_us = time.sleep_us
+else:
+    def _ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def _ticks_us():
+        return int(time.monotonic() * 1000000)
+
+    def _ticks_diff(ticks1, ticks2):
+        return ticks1 - ticks2
+
+    def _ticks_add(ticks, delta):
+        return ticks + delta
+
+    def _sleep_ms(ms):
+        time.sleep(ms / 1000)
+
+    def _sleep_us(us):
+        time.sleep(us / 1000000)
 
 # Allow long also in Python3
 # http://python3porting.com/noconv.html
 _NUMBER_OF_BYTES_PER_REGISTER = 2
 _SECONDS_TO_MILLISECONDS = 1
 
-# Several instrument instances can share the same serialport
-_LATEST_READ_TIMES = {}
+# Largest frame allowed by Modbus RTU (address + PDU + CRC)
+_MAX_RTU_FRAME_SIZE = 256
+
+# Protocol limits for a single read/write of holding/input registers
+_MAX_NUMBER_OF_READ_REGISTERS = 125
+_MAX_NUMBER_OF_WRITE_REGISTERS = 123
+_MAX_NUMBER_OF_READ_WRITE_WRITE_REGISTERS = 121  # Functioncode 23
+
+# Protocol limits for a single read/write of coils and discrete inputs
+_MAX_NUMBER_OF_READ_BITS = 2000
+_MAX_NUMBER_OF_WRITE_BITS = 1968
+
+# Read requests (functioncode 1 to 4) are always this long
+_READ_REQUEST_SIZE = 8
+
+# Response framing: slave address and functioncode, then payload and CRC
+_RESPONSE_HEADER_SIZE = 2
+_NUMBER_OF_CRC_BYTES = 2
+_EXCEPTION_RESPONSE_SIZE = 5
+_WRITE_CONFIRMATION_SIZE = 8
+
+# Several instrument instances can share the same serialport, see Bus
+_BUSES = {}
+
+# Requests to slave address 0 are received by all slaves, and not answered
+_BROADCAST_ADDRESS = 0
+_BROADCAST_FUNCTIONCODES = [5, 6, 15, 16]
+
+_NUMBER_OF_BITS = 1
+_NUMBER_OF_BYTES_FOR_ONE_BIT = 1
+_NUMBER_OF_BYTES_BEFORE_REGISTERDATA = 1
+
+# Payload format constants, so datatypes can be told apart.
+# Note that bit datatype not is included, because it uses other functioncodes.
+_PAYLOADFORMAT_REGISTER  = 'register'
+_PAYLOADFORMAT_REGISTERS = 'registers'
+_PAYLOADFORMAT_BITS      = 'bits'  # Packed bits, for functioncodes 1, 2 and 15
+
+_ALL_PAYLOADFORMATS = [_PAYLOADFORMAT_REGISTER, _PAYLOADFORMAT_REGISTERS, _PAYLOADFORMAT_BITS]
 
 ####################
 ## Default values ##
@@ -63,6 +138,9 @@ STOPBITS = 1
 TIMEOUT  = 1000
 #"""Default value for the timeout value in seconds (float)."""
 
+BROADCAST_DELAY = 100
+#"""Default turnaround delay in ms after a broadcast, for the slaves to process it (int)."""
+
 
 #####################
 ## Named constants ##
@@ -70,6 +148,287 @@ TIMEOUT  = 1000
 
 MODE_RTU   = 'rtu'
 
+# Replies to a discovery probe, see discover()
+SCAN_VALID     = 'valid'      # Normal response
+SCAN_EXCEPTION = 'exception'  # Exception response, the slave is there but rejects the probe
+SCAN_GARBAGE   = 'garbage'    # Corrupt response, often a wrong baudrate or parity
+
+# Transaction errors, see TransactionRecord
+ERROR_TIMEOUT   = 'timeout'    # No (complete) response
+ERROR_CRC       = 'crc'        # Corrupt response
+ERROR_EXCEPTION = 'exception'  # The slave answered with an exception response
+
+################
+## Transports ##
+################
+
+# A transport is the serial I/O of an Instrument. It has the pyb.UART methods used here:
+#   write(buffer), read(nbytes), readinto(buffer, nbytes) and any().
+# read() and readinto() wait up to the timeout for the first byte, and return early
+# (possibly None, or less data) at a gap of 3.5 characters.
+
+
+class UARTTransport():
+#    """Transport on a pyb.UART (MicroPython)."""
+
+    def __init__(self, port, baudrate=BAUDRATE, bytesize=BYTESIZE, parity=PARITY, stopbits=STOPBITS, timeout=TIMEOUT):
+        if UART is None:
+            raise ImportError('pyb.UART is not available. Use SerialTransport or LoopbackTransport.')
+
+        self.uart = UART(port, baudrate)
+        self.uart.init(baudrate, bits = bytesize, stop = stopbits,
+            timeout = timeout, parity = parity,
+            timeout_char = _calculate_inter_frame_timeout(baudrate))
+
+        # Bind the UART methods directly, to avoid a wrapper call per read and write
+        self.write = self.uart.write
+        self.read = self.uart.read
+        self.readinto = self.uart.readinto
+        self.any = self.uart.any
+
+    def __repr__(self):
+        return "{}.{}<uart={!r}>".format(self.__module__, self.__class__.__name__, self.uart)
+
+
+class SerialTransport():
+#    """Transport on a pySerial port (CPython), for example ``/dev/ttyUSB0`` or a pty.
+
+#    The parity is given as for pyb.UART: None, 0 (even) or 1 (odd).
+#    """
+
+    _PARITIES = {None: 'N', 0: 'E', 1: 'O'}
+
+    def __init__(self, port, baudrate=BAUDRATE, bytesize=BYTESIZE, parity=PARITY, stopbits=STOPBITS, timeout=TIMEOUT):
+        import serial
+
+        self.serial = serial.Serial(port,
+            baudrate = baudrate,
+            bytesize = bytesize,
+            parity = self._PARITIES[parity],
+            stopbits = stopbits,
+            timeout = timeout / 1000.0,
+            inter_byte_timeout = _calculate_inter_frame_timeout(baudrate) / 1000.0)
+
+    def __repr__(self):
+        return "{}.{}<serial={!r}>".format(self.__module__, self.__class__.__name__, self.serial)
+
+    def write(self, buffer):
+        return self.serial.write(buffer)
+
+    def read(self, nbytes):
+        return self.serial.read(nbytes)
+
+    def readinto(self, buffer, nbytes=None):
+        if nbytes is None:
+            nbytes = len(buffer)
+        data = self.serial.read(nbytes)
+        buffer[0:len(data)] = data
+        return len(data)
+
+    def any(self):
+        return self.serial.in_waiting
+
+    def close(self):
+        self.serial.close()
+
+
+class LoopbackTransport():
+#    """In-memory transport, for tests and benchmarks without hardware.
+
+#    Without a responder, written data is looped back (like a local echo). With a responder,
+#    responder(request) is called for each written request and its return value (bytes or None)
+#    is what the instrument receives. feed() adds received data directly.
+#    """
+
+    def __init__(self, responder=None):
+        self.responder = responder
+        self._received = bytearray()
+
+    def __repr__(self):
+        return "{}.{}<responder={!r}, pending={}>".format(
+            self.__module__, self.__class__.__name__, self.responder, len(self._received))
+
+    def feed(self, data):
+        self._received.extend(data)
+
+    def write(self, buffer):
+        if self.responder is None:
+            self._received.extend(buffer)
+        else:
+            response = self.responder(bytes(buffer))
+            if response:
+                self._received.extend(response)
+        return len(buffer)
+
+    def read(self, nbytes):
+        if not self._received:
+            return None
+        data = bytes(self._received[0:nbytes])
+        del self._received[0:nbytes]
+        return data
+
+    def readinto(self, buffer, nbytes=None):
+        if not self._received:
+            return None
+        if nbytes is None:
+            nbytes = len(buffer)
+        nbytes = min(nbytes, len(buffer), len(self._received))
+        buffer[0:nbytes] = self._received[0:nbytes]
+        del self._received[0:nbytes]
+        return nbytes
+
+    def any(self):
+        return len(self._received)
+
+################
+## Shared bus ##
+################
+
+
+class Bus():
+#    """Arbitration of one serial port, shared by all instruments on it.
+
+#    Transactions are serialized, and threads waiting for the bus are served in order of
+#    arrival. Created by the Instrument, get it with ``instrument.bus``.
+
+#    Stale input is counted in ``stale_bytes`` (left over bytes drained before a request),
+#    ``resyncs`` (misaligned responses, after which the input was discarded until a silent
+#    period) and ``discarded_bytes`` (the bytes discarded by the resyncs).
+
+#    The bus also times the silent period between frames, in microseconds. The frame gap
+#    (3.5 characters, ``silent_period_us``) and the character gap (1.5 characters,
+#    ``char_gap_us``) are calculated once, when the baudrate is set. Above 19200 Baud the
+#    Modbus specification recommends fixed values of 1750 and 750 us, which some slaves
+#    need: set ``bus.silent_period_us = 1750`` for them.
+
+#    The counters show the contention: ``transactions``, ``contended`` (transactions
+#    that had to wait), ``wait_ms`` (total waiting time) and ``max_wait_ms``, and the
+#    current ``queue_depth`` and its maximum ``max_queue_depth``.
+
+#    Args:
+#        * port: The serial port.
+#    """
+
+    def __init__(self, port):
+        self.port = port
+        self.baudrate = None
+        self.silent_period_us = 0
+        self.char_gap_us = 0
+        self.transactions = 0
+        self.contended = 0
+        self.wait_ms = 0
+        self.max_wait_ms = 0
+        self.max_queue_depth = 0
+        self.stale_bytes = 0
+        self.resyncs = 0
+        self.discarded_bytes = 0
+
+        self._idle_at = 0  # ticks_us() when the next frame may be sent
+        self._hold_us = 0  # The wait scheduled by mark_idle(), to detect a ticks wraparound
+
+        self._busy = False
+        self._waiters = []  # Locks of the waiting threads, in order of arrival
+        self._mutex = _thread.allocate_lock() if _thread is not None else None
+
+    def __repr__(self):
+        return "{}.{}<port={}, queue_depth={}, transactions={}, contended={}, max_wait_ms={}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            self.port,
+            self.queue_depth,
+            self.transactions,
+            self.contended,
+            self.max_wait_ms,
+            )
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Named arguments: varargs would allocate a tuple on each transaction (MicroPython)
+        self.release()
+
+    @property
+    def queue_depth(self):
+        return len(self._waiters)
+
+    def set_baudrate(self, baudrate):
+        self.baudrate = baudrate
+        self.silent_period_us = int(_calculate_transmission_time(baudrate, 3.5) * 1000) + 1
+        self.char_gap_us = int(_calculate_transmission_time(baudrate, 1.5) * 1000) + 1
+
+    def mark_idle(self, delay_us=0):
+        # The latest frame has ended (or was sent, for a broadcast). The next frame may be
+        # sent after the silent period, plus delay_us.
+        self._hold_us = self.silent_period_us + delay_us
+        self._idle_at = _ticks_add(_ticks_us(), self._hold_us)
+
+    def time_until_idle(self):
+        # Microseconds until the next frame may be sent
+        wait = _ticks_diff(self._idle_at, _ticks_us())
+        if wait <= 0 or wait > self._hold_us:
+            return 0  # Passed, or so long ago that the ticks wrapped around
+        return wait
+
+    def wait_until_idle(self):
+        # Sleep for the rest of the silent period. Returns the time slept in us.
+        wait = self.time_until_idle()
+        if wait >= 2000:
+            _sleep_ms(wait // 1000)  # sleep_us() may busy-wait, so sleep the whole ms first
+            _sleep_us(wait % 1000)
+        elif wait > 0:
+            _sleep_us(wait)
+        return wait
+
+    def acquire(self):
+        if self._mutex is None:
+            self.transactions += 1
+            return
+
+        self._mutex.acquire()
+        self.transactions += 1
+        if not self._busy:
+            self._busy = True
+            self._mutex.release()
+            return
+
+        # Wait in line. The releasing thread hands the bus over by releasing our lock.
+        waiter = _thread.allocate_lock()
+        waiter.acquire()
+        self._waiters.append(waiter)
+        if len(self._waiters) > self.max_queue_depth:
+            self.max_queue_depth = len(self._waiters)
+        self._mutex.release()
+
+        start = _ticks_ms()
+        waiter.acquire()
+        waited = _ticks_diff(_ticks_ms(), start)
+
+        # Owning the bus now, so the counters are safe to update
+        self.contended += 1
+        self.wait_ms += waited
+        if waited > self.max_wait_ms:
+            self.max_wait_ms = waited
+
+    def release(self):
+        if self._mutex is None:
+            return
+
+        self._mutex.acquire()
+        if self._waiters:
+            self._waiters.pop(0).release()  # Stays busy, for the next in line
+        else:
+            self._busy = False
+        self._mutex.release()
+
+
+def _getBus(port):
+    bus = _BUSES.get(port)
+    if bus is None:
+        bus = _BUSES.setdefault(port, Bus(port))  # setdefault is atomic, if two threads get here
+    return bus
+
 ##############################
 ## Modbus instrument object ##
 ##############################
@@ -80,8 +439,9 @@ class Instrument():
 
 #    Args:
 #        * port (str): The serial port name, for example ``/dev/ttyUSB0`` (Linux), ``/dev/tty.usbserial`` (OS X) or ``COM4`` (Windows).
-#        * slaveaddress (int): Slave address in the range 1 to 247 (use decimal numbers, not hex).
+#        * slaveaddress (int): Slave address in the range 1 to 247 (use decimal numbers, not hex), or 0 to broadcast writes.
 #        * mode (str): Mode selection. Can be MODE_RTU or MODE_ASCII.
+#        * transport: The serial I/O, see UARTTransport (default), SerialTransport and LoopbackTransport.
 
 #    """
 
@@ -92,10 +452,17 @@ class Instrument():
         self.parity     = kwargs.get('parity', PARITY)
         self.baudrate   = kwargs.get('baudrate', BAUDRATE)
         self.timeout    = kwargs.get('timeout', TIMEOUT)
+        self.broadcast_delay = kwargs.get('broadcast_delay', BROADCAST_DELAY)
+
+        # Shared with the other instruments on the port. The silent period is calculated here,
+        # for the baudrate of the port.
+        self.bus = _getBus(port)
+        self.bus.set_baudrate(self.baudrate)
 
-        self.serial = UART(self.port, self.baudrate)
-        self.serial.init(self.baudrate, bits = self.bytesize, stop = self.stopbits, 
-            timeout = self.timeout, parity = self.parity)
+        self.serial = kwargs.get('transport')
+        if self.serial is None:
+            self.serial = UARTTransport(self.port, self.baudrate, self.bytesize, self.parity, \
+                self.stopbits, self.timeout)
         self.address = slaveaddress
 
         self.mode = mode
@@ -106,6 +473,30 @@ class Instrument():
        
         self.handle_local_echo = False
 
+        # Optional read cache, see enable_cache()
+        self.cache = None
+
+        # Optional adaptive timeout, retries and circuit breaker, see enable_adaptive_timeout()
+        self.health = None
+
+        # Called with a TransactionRecord after each transaction, see add_hook()
+        self.hooks = []
+        self._record = TransactionRecord()
+        self._wait_us = 0
+
+        # Staged register writes, see enable_write_behind()
+        self.write_behind = False
+        self.write_behind_delay = None
+        self._dirty = {}
+        self._dirty_since = 0
+
+        # Preallocated TX/RX buffers, see read_registers_into()
+        self.preallocate = kwargs.get('preallocate', False)
+        self._txbuf = None
+        self._rxbuf = None
+        if self.preallocate:
+            self._allocateBuffers()
+
     def __repr__(self):
         return "{}.{}<id=0x{:x}, address={}, mode={}, close_port_after_each_call={}, precalculate_read_size={}, debug={}, serial={}>".format(
             self.__module__,
@@ -126,187 +517,353 @@ class Instrument():
         _checkBool(signed, description='signed')
         _checkNumerical(value, description='input value')
 
+        if self.write_behind:
+            self._stage(registeraddress, [value], signed)
+            return
+
         self._genericCommand(6, registeraddress, value, signed=signed)
 
 
     def read_registers(self, registeraddress, numberOfRegisters, functioncode=3):
         _checkFunctioncode(functioncode, [3, 4])
         _checkInt(numberOfRegisters, minvalue=1, description='number of registers')
-        return self._genericCommand(functioncode, registeraddress, \
-            numberOfRegisters=numberOfRegisters, payloadformat='registers')
-
-
-    def write_registers(self, registeraddress, values):
-        if not isinstance(values, list):
-            raise TypeError('The "values parameter" must be a list. Given: {0!r}'.format(values))
-        _checkInt(len(values), minvalue=1, description='length of input list')
-        # Note: The content of the list is checked at content conversion.
-
-        self._genericCommand(16, registeraddress, values, numberOfRegisters=len(values), payloadformat='registers')
+        if self._dirty:
+            self.flush()
+
+        if self.cache is not None:
+            key = (self.address, functioncode, registeraddress, numberOfRegisters)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return list(cached)
+
+        if self.preallocate:
+            values = [0] * numberOfRegisters
+            self._readRegistersInto(registeraddress, values, functioncode, False)
+        else:
+            values = self._genericCommand(functioncode, registeraddress, \
+                numberOfRegisters=numberOfRegisters, payloadformat='registers')
 
-    #####################
-    ## Generic command ##
-    #####################
+        if self.cache is not None:
+            self.cache.put(key, values)
+        return values
 
 
-    def _genericCommand(self, functioncode, registeraddress, value=None, \
-            numberOfRegisters=1, signed=False, payloadformat=None):
-        NUMBER_OF_BITS = 1
-        NUMBER_OF_BYTES_FOR_ONE_BIT = 1
-        NUMBER_OF_BYTES_BEFORE_REGISTERDATA = 1
-        ALL_ALLOWED_FUNCTIONCODES = list(range(1, 7)) + [15, 16]  # To comply with both Python2 and Python3
-        MAX_NUMBER_OF_REGISTERS = 255
-
-        # Payload format constants, so datatypes can be told apart.
-        # Note that bit datatype not is included, because it uses other functioncodes.
-        PAYLOADFORMAT_REGISTER  = 'register'
-        PAYLOADFORMAT_REGISTERS = 'registers'
-
-        ALL_PAYLOADFORMATS = [ PAYLOADFORMAT_REGISTER, PAYLOADFORMAT_REGISTERS]
-
-        ## Check input values ##
-        _checkFunctioncode(functioncode, ALL_ALLOWED_FUNCTIONCODES)  # Note: The calling facade functions should validate this
-        _checkRegisteraddress(registeraddress)
-        _checkInt(numberOfRegisters, minvalue=1, maxvalue=MAX_NUMBER_OF_REGISTERS, description='number of registers')
+    def read_registers_array(self, registeraddress, numberOfRegisters, functioncode=3, signed=False):
+        # Read registers into a new array('H'), or array('h') if signed.
         _checkBool(signed, description='signed')
+        _checkInt(numberOfRegisters, minvalue=1, maxvalue=_MAX_NUMBER_OF_READ_REGISTERS, \
+            description='number of registers')
+        values = array('h' if signed else 'H', range(numberOfRegisters))
+        return self.read_registers_into(registeraddress, values, functioncode, signed)
+
+
+    def read_registers_into(self, registeraddress, values, functioncode=3, signed=False):
+        # Read len(values) registers and store them in the caller supplied list or array.
+        # The frame is built in the TX buffer and the response is received into the RX
+        # buffer with readinto(), so a steady-state poll does not allocate on the heap.
+        # Use signed=True for an array('h'), and signed=False for an array('H'): a conflicting
+        # typecode raises ValueError (CPython; MicroPython arrays do not tell their typecode).
+        typecode = getattr(values, 'typecode', None)
+        if (typecode == 'H' and signed) or (typecode == 'h' and not signed):
+            raise ValueError('The array typecode {0!r} does not match signed={1!r}. Use {2!r}.'.format( \
+                typecode, signed, 'h' if signed else 'H'))
+
+        if self._dirty:
+            self.flush()
+
+        if self.cache is not None:
+            # Same key as read_registers(), the cache holds the raw (unsigned) register values
+            key = (self.address, functioncode, registeraddress, len(values))
+            cached = self.cache.get(key)
+            if cached is not None:
+                for i in range(len(values)):
+                    value = cached[i]
+                    if signed and value & 0x8000:
+                        value -= 0x10000
+                    values[i] = value
+                return values
+
+            self._readRegistersInto(registeraddress, values, functioncode, signed)
+            self.cache.put(key, values)
+            return values
+
+        return self._readRegistersInto(registeraddress, values, functioncode, signed)
+
+
+    def _readRegistersInto(self, registeraddress, values, functioncode, signed):
+        if functioncode not in (3, 4):
+            _checkFunctioncode(functioncode, [3, 4])
+        # The checks only call the generic ones to raise, as building their type tuples allocates
+        numberOfRegisters = len(values)
+        if not 1 <= numberOfRegisters <= _MAX_NUMBER_OF_READ_REGISTERS:
+            _checkInt(numberOfRegisters, minvalue=1, maxvalue=_MAX_NUMBER_OF_READ_REGISTERS, \
+                description='number of registers')
+        if not isinstance(registeraddress, int) or not 0 <= registeraddress <= 0xFFFF:
+            _checkRegisteraddress(registeraddress)
+
+        if self.address == _BROADCAST_ADDRESS:
+            _checkBroadcastFunctioncode(functioncode)
+        if self._rxbuf is None:
+            self._allocateBuffers()
+
+        tx = self._txbuf
+        tx[0] = self.address
+        tx[1] = functioncode
+        tx[2] = registeraddress >> 8
+        tx[3] = registeraddress & 0xFF
+        tx[4] = numberOfRegisters >> 8
+        tx[5] = numberOfRegisters & 0xFF
+        crc = _crc16(tx, 0, 6)
+        tx[6] = crc & 0xFF
+        tx[7] = crc >> 8
+
+        number_of_bytes_to_read = 5 + numberOfRegisters * _NUMBER_OF_BYTES_PER_REGISTER
+        received = self._communicateInto(self._readrequest, number_of_bytes_to_read)
+        _checkFrameInto(self._rxbuf, received, self.address, functioncode)
+        _registersFromFrameInto(self._rxbuf, received, values, signed)
+        return values
+
+
+    def enable_cache(self, max_entries=16, ttl_ms=500):
+        # Cache register reads (see ReadCache). Returns the cache, for per-range TTLs and counters.
+        self.cache = ReadCache(max_entries, ttl_ms)
+        return self.cache
+
+
+    def enable_adaptive_timeout(self, min_timeout=10, retries=2, backoff_ms=10, failure_threshold=3, open_ms=5000, \
+            turnaround_ms=100):
+        # Derive the response timeout from the measured roundtrip times, retry failed
+        # transactions and skip the slave after repeated failures (see SlaveHealth).
+        # The timeout given to the Instrument remains the upper limit. Until the first
+        # roundtrip time is measured, the timeout is the time of the longest request frame
+        # plus turnaround_ms for the slave to answer.
+        initial_timeout = int(_calculate_transmission_time(self.baudrate, _MAX_RTU_FRAME_SIZE)) + turnaround_ms
+        self.health = SlaveHealth(self.timeout, min_timeout, retries, backoff_ms, failure_threshold, open_ms, \
+            initial_timeout)
+        return self.health
+
+
+    def add_hook(self, hook):
+        # Call hook(record) after each transaction, for example a TransactionStats.
+        # The TransactionRecord is reused, copy the fields that are kept.
+        self.hooks.append(hook)
+        return hook
+
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+
+    def prepare_read(self, registeraddress, numberOfRegisters, functioncode=3):
+        # Validate and build a read request once, see PreparedRead.
+        _checkFunctioncode(functioncode, [3, 4])
+        if self.address == _BROADCAST_ADDRESS:
+            _checkBroadcastFunctioncode(functioncode)
+        _checkInt(numberOfRegisters, minvalue=1, maxvalue=_MAX_NUMBER_OF_READ_REGISTERS, \
+            description='number of registers')
+        _checkRegisteraddress(registeraddress)
 
-        if payloadformat is not None:
-            if payloadformat not in ALL_PAYLOADFORMATS:
-                raise ValueError('Wrong payload format variable. Given: {0!r}'.format(payloadformat))
-
-        ## Check combinations of input parameters ##
-        numberOfRegisterBytes = numberOfRegisters * _NUMBER_OF_BYTES_PER_REGISTER
-
-                    # Payload format
-        if functioncode in [3, 4, 6, 16] and payloadformat is None:
-            payloadformat = PAYLOADFORMAT_REGISTER
-
-        if functioncode in [3, 4, 6, 16]:
-            if payloadformat not in ALL_PAYLOADFORMATS:
-                raise ValueError('The payload format is unknown. Given format: {0!r}, functioncode: {1!r}.'.\
-                    format(payloadformat, functioncode))
-        else:
-            if payloadformat is not None:
-                raise ValueError('The payload format given is not allowed for this function code. ' + \
-                    'Given format: {0!r}, functioncode: {1!r}.'.format(payloadformat, functioncode))
-
-                    # Signed 
-        if signed:
-            if payloadformat not in [PAYLOADFORMAT_REGISTER, PAYLOADFORMAT_LONG]:
-                raise ValueError('The "signed" parameter can not be used for this data format. ' + \
-                    'Given format: {0!r}.'.format(payloadformat))
-
-                    # Number of registers
-        if functioncode not in [3, 4, 16] and numberOfRegisters != 1:
-            raise ValueError('The numberOfRegisters is not valid for this function code. ' + \
-                'NumberOfRegisters: {0!r}, functioncode {1}.'.format(numberOfRegisters, functioncode))
-
-        if functioncode == 16 and payloadformat == PAYLOADFORMAT_REGISTER and numberOfRegisters != 1:
-            raise ValueError('Wrong numberOfRegisters when writing to a ' + \
-                'single register. Given {0!r}.'.format(numberOfRegisters))
-            # Note: For function code 16 there is checking also in the content conversion functions.
-
-                    # Value
-        if functioncode in [5, 6, 15, 16] and value is None:
-            raise ValueError('The input value is not valid for this function code. ' + \
-                'Given {0!r} and {1}.'.format(value, functioncode))
-
-        if functioncode == 16 and payloadformat in [PAYLOADFORMAT_REGISTER]:
-            _checkNumerical(value, description='input value')
-
-        if functioncode == 6 and payloadformat == PAYLOADFORMAT_REGISTER:
-            _checkNumerical(value, description='input value')
-
-                    # Value for string
-        if functioncode == 16 and payloadformat == PAYLOADFORMAT_REGISTERS:
-            if not isinstance(value, list):
-                raise TypeError('The value parameter must be a list. Given {0!r}.'.format(value))
-
-            if len(value) != numberOfRegisters:
-                raise ValueError('The list length does not match number of registers. ' + \
-                    'List: {0!r},  Number of registers: {1!r}.'.format(value, numberOfRegisters))
-
-        ## Build payload to slave ##
-        if functioncode in [1, 2]:
-            payloadToSlave = _numToTwoByteArray(registeraddress) + \
-                            _numToTwoByteArray(NUMBER_OF_BITS)
-
-        elif functioncode in [3, 4]:
-            payloadToSlave = _numToTwoByteArray(registeraddress) + \
-                            _numToTwoByteArray(numberOfRegisters)
-
-        elif functioncode == 5:
-            payloadToSlave = _numToTwoByteArray(registeraddress) + \
-                            _createBitpattern(functioncode, value)
-
-        elif functioncode == 6:
-            payloadToSlave = _numToTwoByteArray(registeraddress) + \
-                            _numToTwoByteArray(value, signed=signed)
-
-        elif functioncode == 15:
-            payloadToSlave = _numToTwoByteArray(registeraddress) + \
-                            _numToTwoByteArray(NUMBER_OF_BITS) + \
-                            _numToOneByteArray(NUMBER_OF_BYTES_FOR_ONE_BIT) + \
-                            _createBitpattern(functioncode, value)
-
-        elif functioncode == 16:
-            if payloadformat == PAYLOADFORMAT_REGISTER:
-                registerdata = _numToTwoByteArray(value, signed=signed)
-            elif payloadformat == PAYLOADFORMAT_REGISTERS:
-                registerdata = _valuelistToBytestring(value, numberOfRegisters)
-
-            assert len(registerdata) == numberOfRegisterBytes
-            payloadToSlave = _numToTwoByteArray(registeraddress) + \
-                            _numToTwoByteArray(numberOfRegisters) + \
-                            _numToOneByteArray(numberOfRegisterBytes) + \
-                            registerdata
+        payloadToSlave = _numToTwoByteArray(registeraddress) + _numToTwoByteArray(numberOfRegisters)
+        request = _embedPayload(self.address, self.mode, functioncode, payloadToSlave)
+        response_size = _predictResponseSize(self.mode, functioncode, payloadToSlave)
+
+        return PreparedRead(self, functioncode, registeraddress, numberOfRegisters, request, response_size)
+
+
+    def read_plan(self, plan, result=None):
+        # Read the registers of a ScanPlan, one transaction per block.
+        # Returns a dict registeraddress -> value (result is updated in place if given).
+        if not isinstance(plan, ScanPlan):
+            raise TypeError('The plan must be a ScanPlan. Given: {0!r}'.format(plan))
+
+        if result is None:
+            result = {}
+
+        for i in range(len(plan.blocks)):
+            start = plan.blocks[i][0]
+            values = plan._buffers[i]
+            self.read_registers_into(start, values, plan.functioncode)
+            for registeraddress in plan._members[i]:
+                result[registeraddress] = values[registeraddress - start]
+
+        return result
+
+
+    def stream(self, plan, period_ms, count=None):
+        # Generator reading a ScanPlan every period_ms, against absolute deadlines, so the
+        # transaction time does not add up to drift. Yields the same Snapshot every time,
+        # updated in place (see Snapshot). Runs forever, or count times.
+        if not isinstance(plan, ScanPlan):
+            raise TypeError('The plan must be a ScanPlan. Given: {0!r}'.format(plan))
+        _checkInt(period_ms, minvalue=1, description='period_ms')
+
+        snapshot = Snapshot()
+        deadline = _ticks_ms()
+        while count is None or snapshot.sequence < count:
+            late = _ticks_diff(_ticks_ms(), deadline)
+            if late < 0:
+                _sleep_ms(-late)
+                late = 0
+            elif late >= period_ms:
+                # Overrun: keep the cadence, skipping (and counting) the deadlines that passed
+                skipped = late // period_ms
+                snapshot.overruns += skipped
+                deadline = _ticks_add(deadline, skipped * period_ms)
+                late -= skipped * period_ms
+
+            snapshot.timestamp = _ticks_ms()
+            snapshot.late_ms = late
+            try:
+                self.read_plan(plan, snapshot.values)
+                snapshot.error = None
+            except (IOError, ValueError) as error:
+                snapshot.error = error
+                snapshot.errors += 1
+
+            snapshot.sequence += 1
+            deadline = _ticks_add(deadline, period_ms)
+            yield snapshot
+
+
+    def read_write_registers(self, readaddress, numberOfRegisters, writeaddress, values, signed=False):
+        # Write values starting at writeaddress and read numberOfRegisters starting at readaddress,
+        # in one transaction (functioncode 23). The slave writes before it reads.
+        # signed applies to both the written and the returned values.
+        if not isinstance(values, (list, array)):
+            raise TypeError('The "values parameter" must be a list or an array. Given: {0!r}'.format(values))
+        _checkInt(numberOfRegisters, minvalue=1, maxvalue=_MAX_NUMBER_OF_READ_REGISTERS, \
+            description='number of registers to read')
+
+        if self._dirty:
+            self.flush()
+
+        return self._genericCommand(23, readaddress, values, numberOfRegisters=numberOfRegisters, \
+            signed=signed, payloadformat='registers', writeaddress=writeaddress)
+
+
+    def read_bits(self, bitaddress, numberOfBits, functioncode=2):
+        # Read up to 2000 coils (functioncode 1) or discrete inputs (functioncode 2).
+        # Returns the bits packed in a bytearray, as sent by the slave:
+        # bit i is (result[i // 8] >> (i % 8)) & 1
+        _checkFunctioncode(functioncode, [1, 2])
+        _checkInt(numberOfBits, minvalue=1, maxvalue=_MAX_NUMBER_OF_READ_BITS, description='number of bits')
+        return self._genericCommand(functioncode, bitaddress, payloadformat='bits', numberOfBits=numberOfBits)
+
+
+    def write_bits(self, bitaddress, bits, numberOfBits=None):
+        # Write up to 1968 coils (functioncode 15). The bits are given packed in a bytearray
+        # (like read_bits() returns them, numberOfBits defaults to all bits of it), or as a list of 0/1.
+        if isinstance(bits, list):
+            if numberOfBits is None:
+                numberOfBits = len(bits)
+            bits = _packBits(bits)
+        elif not isinstance(bits, (bytes, bytearray)):
+            raise TypeError('The bits must be a bytearray or a list. Given: {0!r}'.format(bits))
+        elif numberOfBits is None:
+            numberOfBits = len(bits) * 8
+
+        _checkInt(numberOfBits, minvalue=1, maxvalue=_MAX_NUMBER_OF_WRITE_BITS, description='number of bits')
+        self._genericCommand(15, bitaddress, bytearray(bits), payloadformat='bits', numberOfBits=numberOfBits)
+
+
+    def write_registers(self, registeraddress, values, signed=False):
+        # The values can be a list, or an array('H') (array('h') if signed) that is packed in bulk.
+        if not isinstance(values, (list, array)):
+            raise TypeError('The "values parameter" must be a list or an array. Given: {0!r}'.format(values))
+        _checkInt(len(values), minvalue=1, description='length of input list')
+        # Note: The content of the list is checked at content conversion.
 
-        ## Communicate ##
-        payloadFromSlave = self._performCommand(functioncode, payloadToSlave)
+        if self.write_behind:
+            self._stage(registeraddress, values, signed)
+            return
+
+        self._genericCommand(16, registeraddress, values, numberOfRegisters=len(values), signed=signed, \
+            payloadformat='registers')
+
+    #########################
+    ## Write-behind buffer ##
+    #########################
+
+    def enable_write_behind(self, max_delay_ms=None):
+        # Stage register writes instead of sending them. The staged registers are written with
+        # the fewest FC16 frames by flush(), before each read, and by flush_if_due() once the
+        # oldest staged write is max_delay_ms old (if given).
+        # Note: PreparedRead requests do not flush the staged writes.
+        if max_delay_ms is not None:
+            _checkInt(max_delay_ms, minvalue=0, description='max_delay_ms')
+        self.write_behind = True
+        self.write_behind_delay = max_delay_ms
+
+
+    def disable_write_behind(self):
+        self.flush()
+        self.write_behind = False
+
+
+    def flush(self):
+        # Write the staged registers, one FC16 frame per run of adjacent addresses.
+        # Returns the number of frames.
+        if not self._dirty:
+            return 0
+
+        runs = _planBlocks(sorted(self._dirty), 0, _MAX_NUMBER_OF_WRITE_REGISTERS)
+        for run in runs:
+            values = [self._dirty[registeraddress] for registeraddress in run]
+            self._genericCommand(16, run[0], values, numberOfRegisters=len(values), payloadformat='registers')
+            for registeraddress in run:
+                del self._dirty[registeraddress]
+        return len(runs)
+
+
+    def flush_if_due(self):
+        # Flush if the oldest staged write is older than the write-behind delay.
+        # Call this from the main loop. Returns the number of frames.
+        if self._dirty and self.write_behind_delay is not None and \
+                _ticks_diff(_ticks_ms(), self._dirty_since) >= self.write_behind_delay:
+            return self.flush()
+        return 0
 
-        ## Check the contents in the response payload ##
-        if functioncode in [1, 2, 3, 4]:
-            _checkResponseByteCount(payloadFromSlave)  # response byte count
 
-        if functioncode in [5, 6, 15, 16]:
-            _checkResponseRegisterAddress(payloadFromSlave, registeraddress)  # response register address
+    def _stage(self, registeraddress, values, signed):
+        _checkRegisteraddress(registeraddress)
+        _checkRegisteraddress(registeraddress + len(values) - 1)
 
-        if functioncode == 5:
-            _checkResponseWriteData(payloadFromSlave, _createBitpattern(functioncode, value))  # response write data
+        # Convert (and validate) all values before staging any of them
+        registerdata = _valuelistToBytestring(list(values), len(values), signed)
 
-        if functioncode == 6:
-            _checkResponseWriteData(payloadFromSlave, \
-                _numToTwoByteArray(value, signed=signed))  # response write data
+        if not self._dirty:
+            self._dirty_since = _ticks_ms()
+        for i in range(len(values)):
+            offset = i * _NUMBER_OF_BYTES_PER_REGISTER
+            self._dirty[registeraddress + i] = (registerdata[offset] << 8) | registerdata[offset + 1]
 
-        if functioncode == 15:
-            _checkResponseNumberOfRegisters(payloadFromSlave, NUMBER_OF_BITS)  # response number of bits
+        self.flush_if_due()
 
-        if functioncode == 16:
-            _checkResponseNumberOfRegisters(payloadFromSlave, numberOfRegisters)  # response number of registers
+    #####################
+    ## Generic command ##
+    #####################
 
-        ## Calculate return value ##
-        if functioncode in [1, 2]:
-            registerdata = payloadFromSlave[NUMBER_OF_BYTES_BEFORE_REGISTERDATA:]
-            if len(registerdata) != NUMBER_OF_BYTES_FOR_ONE_BIT:
-                raise ValueError('The registerdata length does not match NUMBER_OF_BYTES_FOR_ONE_BIT. ' + \
-                    'Given {0}.'.format(len(registerdata)))
 
-            return _bitResponseToValue(registerdata)
+    def _genericCommand(self, functioncode, registeraddress, value=None, \
+            numberOfRegisters=1, signed=False, payloadformat=None, writeaddress=None, numberOfBits=1):
+        payloadToSlave, payloadformat = _createPayload(functioncode, registeraddress, value, \
+            numberOfRegisters, signed, payloadformat, writeaddress, numberOfBits)
 
-        if functioncode in [3, 4]:
-            registerdata = payloadFromSlave[NUMBER_OF_BYTES_BEFORE_REGISTERDATA:]
-            if len(registerdata) != numberOfRegisterBytes:
-                raise ValueError('The registerdata length does not match number of register bytes. ' + \
-                    'Given {0!r} and {1!r}.'.format(len(registerdata), numberOfRegisterBytes))
+        if self.cache is not None:
+            if functioncode in (6, 16):
+                self.cache.invalidate(self.address, registeraddress, numberOfRegisters)
+            elif functioncode == 23:
+                self.cache.invalidate(self.address, writeaddress, len(value))
 
-            elif payloadformat == PAYLOADFORMAT_REGISTERS:
-                return _bytearrayToValuelist(registerdata, numberOfRegisters)
+        if self.address == _BROADCAST_ADDRESS:
+            self._broadcast(functioncode, payloadToSlave)
+            return None
 
-            elif payloadformat == PAYLOADFORMAT_REGISTER:
-                return _twoByteStringToNum(registerdata, signed=signed)
+        ## Communicate ##
+        payloadFromSlave = self._performCommand(functioncode, payloadToSlave)
 
-            raise ValueError('Wrong payloadformat for return value generation. ' + \
-                'Given {0}'.format(payloadformat))
+        return _interpretPayload(functioncode, registeraddress, value, \
+            numberOfRegisters, signed, payloadformat, payloadFromSlave, numberOfBits)
 
     ##########################################
     ## Communication implementation details ##
@@ -314,24 +871,22 @@ class Instrument():
 
 
     def _performCommand(self, functioncode, payloadToSlave):
-        DEFAULT_NUMBER_OF_BYTES_TO_READ = 1000
-
         _checkFunctioncode(functioncode, None)
         _checkString(payloadToSlave, description='payload')
 
         # Build request
         request = _embedPayload(self.address, self.mode, functioncode, payloadToSlave)
 
-        # Calculate number of bytes to read
-        number_of_bytes_to_read = DEFAULT_NUMBER_OF_BYTES_TO_READ
+        # Calculate number of bytes to read. If unknown, the frame boundary is detected from the response.
+        number_of_bytes_to_read = None
         if self.precalculate_read_size:
             try:
                 number_of_bytes_to_read = _predictResponseSize(self.mode, functioncode, payloadToSlave)
             except:
                 if self.debug:
                     template = 'MinimalModbus debug mode. Could not precalculate response size for Modbus {} mode. ' + \
-                        'Will read {} bytes. request: {!r}'
-                    _print_out(template.format(self.mode, number_of_bytes_to_read, request))
+                        'Will detect the end of the response frame. request: {!r}'
+                    _print_out(template.format(self.mode, request))
 
 
         # Communicate
@@ -342,64 +897,89 @@ class Instrument():
         return payloadFromSlave
 
 
+    def _broadcast(self, functioncode, payloadToSlave):
+        # Send a request to all slaves. Nothing is read back, but the next request on
+        # the port waits for the turnaround delay, so the slaves have time to process it.
+        _checkBroadcastFunctioncode(functioncode)
+
+        request = _embedPayload(self.address, self.mode, functioncode, payloadToSlave)
+        if self.debug:
+            _print_out('\nMinimalModbus debug mode. Broadcasting: {!r} ({}), turnaround delay: {} ms'. \
+                format(request, _hexlify(request), self.broadcast_delay))
+
+        with self.bus:
+            latest_write_time = self._writeRequest(request)
+
+            echo_failed = False
+            try:
+                if self.handle_local_echo:
+                    localEchoToDiscard = self.serial.read(len(request))
+                    if localEchoToDiscard != request:
+                        echo_failed = True
+                        template = 'Local echo handling is enabled, but the local echo does not match the sent request. ' + \
+                            'Request: {!r} ({} bytes), local echo: {!r}.'
+                        raise IOError(template.format(request, len(request), localEchoToDiscard))
+            finally:
+                # The silent period before the next request is counted from the end of the delay
+                transmission_time = _calculate_transmission_time(self.baudrate, len(request))
+                self.bus.mark_idle(int((transmission_time + self.broadcast_delay) * 1000))
+
+                if self.hooks:
+                    self._report(request, b'', 0, latest_write_time, echo_failed)
+
+
     def _communicate(self, request, number_of_bytes_to_read):
+        if self.health is None:
+            return self._communicateOnce(request, number_of_bytes_to_read)
+        return self.health.call(self._communicateChecked, request, number_of_bytes_to_read)
+
+
+    def _communicateChecked(self, request, number_of_bytes_to_read):
+        # For the circuit breaker: a corrupt response fails the transaction like no response.
+        # An exception response is a valid answer, _extractPayload() raises for it later.
+        answer = self._communicateOnce(request, number_of_bytes_to_read)
+        _checkResponseFrame(answer, len(answer), request)
+        return answer
+
+
+    def _communicateOnce(self, request, number_of_bytes_to_read):
         _checkString(request, minlength=1, description='request')
-        _checkInt(number_of_bytes_to_read)
+        if number_of_bytes_to_read is not None:
+            _checkInt(number_of_bytes_to_read)
 
         if self.debug:
             _print_out('\nMinimalModbus debug mode. Writing to instrument (expecting {} bytes back): {!r} ({})'. \
                 format(number_of_bytes_to_read, request, _hexlify(request)))
 
+        with self.bus:
+            latest_write_time = self._writeRequest(request)
 
-        #self.serial.flushInput() TODO
-
-        # Sleep to make sure 3.5 character times have passed
-        minimum_silent_period   = _calculate_minimum_silent_period(self.baudrate)
-        time_since_read         = time.ticks_ms() - _LATEST_READ_TIMES.get(self.port, 0)
-
-        if time_since_read < minimum_silent_period:
-            sleep_time = minimum_silent_period - time_since_read
-
-            if self.debug:
-                template = 'MinimalModbus debug mode. Sleeping for {:.1f} ms. ' + \
-                        'Minimum silent period: {:.1f} ms, time since read: {:.1f} ms.'
-                text = template.format(
-                    sleep_time * _SECONDS_TO_MILLISECONDS,
-                    minimum_silent_period * _SECONDS_TO_MILLISECONDS,
-                    time_since_read * _SECONDS_TO_MILLISECONDS)
-                _print_out(text)
-
-            time.sleep_ms(sleep_time)
-
-        elif self.debug:
-            template = 'MinimalModbus debug mode. No sleep required before write. ' + \
-                'Time since previous read: {:.1f} ms, minimum silent period: {:.2f} ms.'
-            text = template.format(
-                time_since_read * _SECONDS_TO_MILLISECONDS,
-                minimum_silent_period * _SECONDS_TO_MILLISECONDS)
-            _print_out(text)
-
-        # Write request
-        latest_write_time = time.ticks_ms()
-        
-        self.serial.write(request)
-
-        # Read and discard local echo
-        if self.handle_local_echo:
-            localEchoToDiscard = self.serial.read(len(request))
-            if self.debug:
-                template = 'MinimalModbus debug mode. Discarding this local echo: {!r} ({} bytes).' 
-                text = template.format(localEchoToDiscard, len(localEchoToDiscard))
-                _print_out(text)
-            if localEchoToDiscard != request:
-                template = 'Local echo handling is enabled, but the local echo does not match the sent request. ' + \
-                    'Request: {!r} ({} bytes), local echo: {!r} ({} bytes).' 
-                text = template.format(request, len(request), localEchoToDiscard, len(localEchoToDiscard))
-                raise IOError(text)
-
-        # Read response
-        answer = self.serial.read(number_of_bytes_to_read)
-        _LATEST_READ_TIMES[self.port] = time.ticks_ms()
+            # The bus is marked idle and the hooks are called also when the echo check fails
+            answer = b''
+            try:
+                # Read and discard local echo
+                if self.handle_local_echo:
+                    localEchoToDiscard = self.serial.read(len(request)) or b''
+                    if self.debug:
+                        template = 'MinimalModbus debug mode. Discarding this local echo: {!r} ({} bytes).'
+                        text = template.format(localEchoToDiscard, len(localEchoToDiscard))
+                        _print_out(text)
+                    if localEchoToDiscard != request:
+                        template = 'Local echo handling is enabled, but the local echo does not match the sent request. ' + \
+                            'Request: {!r} ({} bytes), local echo: {!r} ({} bytes).'
+                        text = template.format(request, len(request), localEchoToDiscard, len(localEchoToDiscard))
+                        raise IOError(text)
+
+                # Read response
+                if self.health is not None:
+                    self._awaitResponse(latest_write_time)
+                answer = self._readResponse(number_of_bytes_to_read)
+                if answer:
+                    self._resyncIfMisaligned(request, answer, len(answer), number_of_bytes_to_read)
+            finally:
+                self.bus.mark_idle()
+                if self.hooks:
+                    self._report(request, answer, len(answer), latest_write_time)
 
         if self.debug:
             template = 'MinimalModbus debug mode. Response from instrument: {!r} ({}) ({} bytes), ' + \
@@ -408,7 +988,7 @@ class Instrument():
                 answer,
                 _hexlify(answer),
                 len(answer),
-                (_LATEST_READ_TIMES.get(self.port, 0) - latest_write_time) * _SECONDS_TO_MILLISECONDS,
+                _ticks_diff(_ticks_ms(), latest_write_time) * _SECONDS_TO_MILLISECONDS,
                 self.timeout * _SECONDS_TO_MILLISECONDS)
             _print_out(text)
 
@@ -417,11 +997,1327 @@ class Instrument():
 
         return answer
 
+
+    def _communicateInto(self, request, number_of_bytes_to_read):
+        # Same as _communicate(), but the response is received into the preallocated
+        # RX buffer. Returns the number of bytes received.
+        if self.health is None:
+            return self._communicateIntoOnce(request, number_of_bytes_to_read)
+        return self.health.call(self._communicateIntoChecked, request, number_of_bytes_to_read)
+
+
+    def _communicateIntoChecked(self, request, number_of_bytes_to_read):
+        received = self._communicateIntoOnce(request, number_of_bytes_to_read)
+        _checkResponseFrame(self._rxbuf, received, request)
+        return received
+
+
+    def _communicateIntoOnce(self, request, number_of_bytes_to_read):
+        with self.bus:
+            rx = self._rxbuf
+            latest_write_time = self._writeRequest(request)
+
+            # The bus is marked idle and the hooks are called also when the echo check fails
+            received = 0
+            try:
+                if self.handle_local_echo:
+                    numberOfEchoBytes = len(request)
+                    echoed = self.serial.readinto(rx, numberOfEchoBytes) or 0
+                    if echoed != numberOfEchoBytes or not _buffersEqual(rx, request, numberOfEchoBytes):
+                        template = 'Local echo handling is enabled, but the local echo does not match the sent request. ' + \
+                            'Request: {!r} ({} bytes), local echo: {!r} ({} bytes).'
+                        raise IOError(template.format(bytes(request), numberOfEchoBytes, bytes(rx[:echoed]), echoed))
+
+                # Header first, so that an exception response ends the read early
+                if self.health is not None:
+                    self._awaitResponse(latest_write_time)
+                received = self.serial.readinto(rx, _RESPONSE_HEADER_SIZE) or 0
+                if received == _RESPONSE_HEADER_SIZE:
+                    remaining = _remainingResponseSize(rx[1], number_of_bytes_to_read)
+                    received += self.serial.readinto(self._rxtail, remaining) or 0
+                if received:
+                    self._resyncIfMisaligned(request, rx, received, number_of_bytes_to_read)
+            finally:
+                self.bus.mark_idle()
+                if self.hooks:
+                    self._report(request, rx, received, latest_write_time)
+
+        if self.debug:
+            _print_out('MinimalModbus debug mode. Response from instrument: {} ({} bytes).'.format( \
+                _hexlify(rx[:received or 0]), received or 0))
+
+        if not received:
+            raise IOError('No communication with the instrument (no answer)')
+
+        return received
+
+
+    def _readResponse(self, number_of_bytes_to_read):
+        # Read a response frame and return as soon as it is complete: the header tells
+        # exception responses apart, and the byte count field gives the length when
+        # number_of_bytes_to_read is None. Unknown frames end at the inter-frame gap.
+        answer = self.serial.read(_RESPONSE_HEADER_SIZE)
+        if not answer or len(answer) < _RESPONSE_HEADER_SIZE:
+            return answer or b''
+
+        remaining = _remainingResponseSize(answer[1], number_of_bytes_to_read)
+        if remaining is None:
+            bytecount = self.serial.read(1)
+            if not bytecount:
+                return answer
+            answer += bytecount
+            remaining = bytecount[0] + _NUMBER_OF_CRC_BYTES
+
+        rest = self.serial.read(remaining)
+        if rest:
+            answer += rest
+        return answer
+
+
+    def _resyncIfMisaligned(self, request, response, received, number_of_bytes_to_read):
+        # A response that does not start like the request, has the wrong length or is followed
+        # by more bytes means that the stream is out of step with the frames (a late reply,
+        # noise). Checked without the CRC, which the caller checks anyway.
+        if received >= _RESPONSE_HEADER_SIZE:
+            if response[1] == request[1] | 0x80:
+                number_of_bytes_to_read = _EXCEPTION_RESPONSE_SIZE
+            if response[0] == request[0] and response[1] & 0x7F == request[1] and \
+                    (number_of_bytes_to_read is None or received == number_of_bytes_to_read) and \
+                    not self.serial.any():
+                return
+        self._resync()
+
+
+    def _resync(self):
+        # Discard the input until a silent period passes without data, or for at most the timeout
+        bus = self.bus
+        bus.resyncs += 1
+        start = _ticks_ms()
+        while True:
+            bus.mark_idle()
+            bus.wait_until_idle()
+            number_of_bytes = self.serial.any()
+            if not number_of_bytes:
+                return
+            bus.discarded_bytes += len(self.serial.read(number_of_bytes) or b'')
+            if _ticks_diff(_ticks_ms(), start) >= self.timeout:
+                return
+
+
+    def _drainInput(self):
+        # Discard bytes that arrived since the latest transaction, like a late response
+        while True:
+            number_of_bytes = self.serial.any()
+            if not number_of_bytes:
+                return
+            self.bus.stale_bytes += len(self.serial.read(number_of_bytes) or b'')
+
+
+    def _report(self, request, response, received, latest_write_time, echo_failed=False):
+        # Fill in the transaction record and call the hooks. A failed local echo check
+        # is reported like a timeout, as no response has been read.
+        record = self._record
+        record.slaveaddress = request[0]
+        record.functioncode = request[1]
+        record.sent = len(request)
+        record.received = received
+        record.wait_us = self._wait_us
+        record.time_ms = latest_write_time
+        record.rtt_ms = _ticks_diff(_ticks_ms(), latest_write_time)
+        record.request = request
+        record.response = response
+
+        if echo_failed:
+            record.error = ERROR_TIMEOUT
+        elif request[0] == _BROADCAST_ADDRESS:
+            record.error = None  # No response is expected
+        elif received < _RESPONSE_HEADER_SIZE:
+            record.error = ERROR_TIMEOUT
+        elif received < _EXCEPTION_RESPONSE_SIZE or _crc16(response, 0, received) != 0:
+            record.error = ERROR_CRC  # Checking the whole frame including its CRC gives 0
+        elif response[1] & 0x80:
+            record.error = ERROR_EXCEPTION
+        else:
+            record.error = None
+
+        for hook in self.hooks:
+            hook(record)
+
+
+    def _awaitResponse(self, latest_write_time):
+        # Wait for the first byte of the response, at most the adaptive timeout.
+        # The time until it arrives is the roundtrip time sample.
+        health = self.health
+        while not self.serial.any():
+            if _ticks_diff(_ticks_ms(), latest_write_time) >= health.timeout:
+                health.timeouts += 1
+                raise IOError('No communication with the instrument (no answer within {} ms)'.format(health.timeout))
+            _sleep_ms(1)
+        health.record(_ticks_diff(_ticks_ms(), latest_write_time))
+
+
+    def _writeRequest(self, request):
+        # Wait for the silent period on the bus and write the request.
+        # Returns the time of writing. Call with the bus acquired.
+
+        # Sleep to make sure 3.5 character times have passed
+        self._wait_us = self.bus.wait_until_idle()
+
+        self._drainInput()
+
+        if self.debug:
+            template = 'MinimalModbus debug mode. Slept for {} us. Minimum silent period: {} us.'
+            _print_out(template.format(self._wait_us, self.bus.silent_period_us))
+
+        # Write request
+        latest_write_time = _ticks_ms()
+        
+        self.serial.write(request)
+
+        return latest_write_time
+
+
+    def _allocateBuffers(self):
+        self._txbuf = bytearray(_MAX_RTU_FRAME_SIZE)
+        self._rxbuf = bytearray(_MAX_RTU_FRAME_SIZE)
+
+        # Read requests always occupy the first 8 bytes of the TX buffer
+        self._readrequest = memoryview(self._txbuf)[0:_READ_REQUEST_SIZE]
+
+        # Responses are received header first, and then the rest after it
+        self._rxtail = memoryview(self._rxbuf)[_RESPONSE_HEADER_SIZE:]
+
+################
+## Read cache ##
+################
+
+
+class ReadCache():
+#    """Cache for register reads, keyed by (slave, functioncode, address range).
+
+#    The raw (unsigned) register values are stored, readers apply signed themselves.
+#    Entries expire after ttl_ms, which can be set per register range with set_ttl().
+#    At most max_entries are kept, the least recently used is evicted first. Writes of holding
+#    registers through the Instrument invalidate the overlapping entries.
+#    The counters ``hits``, ``misses`` and ``evictions`` show how well it works.
+
+#    Args:
+#        * max_entries (int): Maximum number of cached reads.
+#        * ttl_ms (int): Default time to live in ms.
+#    """
+
+    def __init__(self, max_entries=16, ttl_ms=500):
+        _checkInt(max_entries, minvalue=1, description='max_entries')
+        _checkInt(ttl_ms, minvalue=0, description='ttl_ms')
+
+        self.max_entries = max_entries
+        self.ttl_ms = ttl_ms
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._ttl_ranges = []  # [first registeraddress, last registeraddress, ttl_ms]
+        self._entries = {}     # key -> [read time, last use, values]
+        self._uses = 0
+
+    def __repr__(self):
+        return "{}.{}<entries={}, max_entries={}, ttl_ms={}, hits={}, misses={}, evictions={}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            len(self._entries),
+            self.max_entries,
+            self.ttl_ms,
+            self.hits,
+            self.misses,
+            self.evictions,
+            )
+
+    def set_ttl(self, registeraddress, numberOfRegisters, ttl_ms):
+        # Use ttl_ms for reads overlapping this register range. The shortest matching TTL wins.
+        _checkRegisteraddress(registeraddress)
+        _checkInt(numberOfRegisters, minvalue=1, description='number of registers')
+        _checkInt(ttl_ms, minvalue=0, description='ttl_ms')
+
+        self._ttl_ranges.append([registeraddress, registeraddress + numberOfRegisters - 1, ttl_ms])
+        self.clear()
+
+    def get(self, key):
+        # Returns the cached values (a tuple), or None
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if _ticks_diff(_ticks_ms(), entry[0]) >= self._ttl(key):
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._uses += 1
+        entry[1] = self._uses
+        self.hits += 1
+        return entry[2]
+
+    def put(self, key, values):
+        if key not in self._entries and len(self._entries) >= self.max_entries:
+            self._evict()
+
+        self._uses += 1
+        self._entries[key] = [_ticks_ms(), self._uses, tuple(value & 0xFFFF for value in values)]
+
+    def invalidate(self, slaveaddress, registeraddress, numberOfRegisters):
+        # Remove the cached holding register reads that overlap the written range
+        last = registeraddress + numberOfRegisters - 1
+        for key in list(self._entries):
+            if key[0] == slaveaddress and key[1] == 3 and \
+                    key[2] <= last and registeraddress <= key[2] + key[3] - 1:
+                del self._entries[key]
+
+    def clear(self):
+        self._entries = {}
+
+    def _ttl(self, key):
+        ttl = None
+        first = key[2]
+        last = first + key[3] - 1
+        for ttl_range in self._ttl_ranges:
+            if ttl_range[0] <= last and first <= ttl_range[1]:
+                if ttl is None or ttl_range[2] < ttl:
+                    ttl = ttl_range[2]
+        return self.ttl_ms if ttl is None else ttl
+
+    def _evict(self):
+        oldest = None
+        for key, entry in self._entries.items():
+            if oldest is None or entry[1] < self._entries[oldest][1]:
+                oldest = key
+        del self._entries[oldest]
+        self.evictions += 1
+
+#####################
+## Instrumentation ##
+#####################
+
+
+class TransactionRecord():
+#    """What happened in one transaction, given to the hooks of an Instrument.
+
+#    Attributes:
+#        * slaveaddress (int), functioncode (int): From the request.
+#        * sent (int), received (int): Number of bytes of the request and the response.
+#        * wait_us (int): Time waited for the silent period before writing, in us.
+#        * time_ms (int): Ticks (ms) of writing the request.
+#        * rtt_ms (int): Time from writing the request to the end of the response (or the timeout).
+#        * error: None, ERROR_TIMEOUT, ERROR_CRC or ERROR_EXCEPTION. Broadcasts are reported
+#          with slaveaddress 0, received 0 and error None.
+#        * request, response: The frames, only valid during the hook call. The response is the
+#          first ``received`` bytes of ``response``.
+#    """
+
+    def __init__(self):
+        self.slaveaddress = 0
+        self.functioncode = 0
+        self.sent = 0
+        self.received = 0
+        self.wait_us = 0
+        self.time_ms = 0
+        self.rtt_ms = 0
+        self.error = None
+        self.request = b''
+        self.response = b''
+
+    def __repr__(self):
+        return "{}.{}<slaveaddress={}, functioncode={}, sent={}, received={}, wait_us={}, rtt_ms={}, error={}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            self.slaveaddress,
+            self.functioncode,
+            self.sent,
+            self.received,
+            self.wait_us,
+            self.rtt_ms,
+            self.error,
+            )
+
+
+class TransactionStats():
+#    """Counters and fixed-size histograms of transactions, to register with Instrument.add_hook().
+
+#    One TransactionStats can be added to several instruments, for the totals of a bus.
+#    Histogram bucket i counts the values up to bounds[i] ms, the last bucket the larger ones.
+
+#    Args:
+#        * bounds: Upper bounds in ms of the histogram buckets, increasing.
+#    """
+
+    BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = array('H', bounds)
+        self.rtt_histogram = array('L', [0] * (len(bounds) + 1))
+        self.wait_histogram = array('L', [0] * (len(bounds) + 1))
+        self.reset()
+
+    def __repr__(self):
+        return "{}.{}<transactions={}, timeouts={}, crc_errors={}, exceptions={}, utilization={:.2f}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            self.transactions,
+            self.timeouts,
+            self.crc_errors,
+            self.exceptions,
+            self.utilization,
+            )
+
+    def __call__(self, record):
+        self.transactions += 1
+        self.bytes_sent += record.sent
+        self.bytes_received += record.received
+        self.wait_us += record.wait_us
+        self.busy_ms += record.rtt_ms
+
+        error = record.error
+        if error is not None:
+            if error == ERROR_TIMEOUT:
+                self.timeouts += 1
+            elif error == ERROR_CRC:
+                self.crc_errors += 1
+            else:
+                self.exceptions += 1
+
+        self.rtt_histogram[self._bucket(record.rtt_ms)] += 1
+        self.wait_histogram[self._bucket(record.wait_us // 1000)] += 1
+
+    @property
+    def utilization(self):
+        # Part of the time since reset() that the bus was busy with transactions
+        elapsed = _ticks_diff(_ticks_ms(), self.started)
+        return min(1.0, self.busy_ms / elapsed) if elapsed > 0 else 0.0
+
+    def rtt_percentile(self, percent):
+        # Upper bound (ms) of the histogram bucket holding the percentile, None above the largest bound
+        return self._percentile(self.rtt_histogram, percent)
+
+    def wait_percentile(self, percent):
+        return self._percentile(self.wait_histogram, percent)
+
+    def reset(self):
+        self.transactions = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.wait_us = 0
+        self.busy_ms = 0
+        self.timeouts = 0
+        self.crc_errors = 0
+        self.exceptions = 0
+        for i in range(len(self.rtt_histogram)):
+            self.rtt_histogram[i] = 0
+            self.wait_histogram[i] = 0
+        self.started = _ticks_ms()
+
+    def _bucket(self, value):
+        bounds = self.bounds
+        for i in range(len(bounds)):
+            if value <= bounds[i]:
+                return i
+        return len(bounds)
+
+    def _percentile(self, histogram, percent):
+        total = sum(histogram)
+        if not total:
+            return None
+        rank = total * percent / 100
+        count = 0
+        for i in range(len(self.bounds)):
+            count += histogram[i]
+            if count >= rank:
+                return self.bounds[i]
+        return None
+
+##################
+## Slave health ##
+##################
+
+
+class SlaveHealth():
+#    """Roundtrip time statistics, adaptive timeout, retries and circuit breaker of one slave.
+
+#    Created by Instrument.enable_adaptive_timeout(). The smoothed roundtrip time and its
+#    variation are kept like in TCP (RFC 6298), in integer ms, and the timeout is
+#    ``rtt + 4 * rttvar``. It is never below the slowest of the recent samples, nor below
+#    min_timeout, nor above max_timeout. A timeout doubles the current timeout, until the
+#    next sample, but only for the retries: each transaction starts with the timeout of the
+#    roundtrip times again, so does the probe of a half open circuit. Until the first sample
+#    the timeout is initial_timeout.
+
+#    A failed transaction (IOError, or ValueError for a corrupt response) is retried up to ``retries`` times, after backoff_ms,
+#    2 * backoff_ms, ... After failure_threshold failed transactions in a row the circuit
+#    opens: for open_ms all transactions with the slave fail at once, without using the bus.
+#    Then one transaction is tried, and its result closes or opens the circuit again.
+
+#    Args:
+#        * max_timeout (int): Upper limit of the timeout in ms, and the timeout until the first sample.
+#        * min_timeout (int): Lower limit of the timeout in ms.
+#        * retries (int): Number of retries of a failed transaction.
+#        * backoff_ms (int): Wait before the first retry, doubled for each following retry.
+#        * failure_threshold (int): Number of failed transactions in a row that opens the circuit.
+#        * open_ms (int): Time the circuit stays open.
+#        * initial_timeout (int): Timeout in ms until the first sample, at most max_timeout.
+#    """
+
+    WINDOW = 32  # Number of recent samples kept for percentiles
+
+    def __init__(self, max_timeout=TIMEOUT, min_timeout=10, retries=2, backoff_ms=10, failure_threshold=3, open_ms=5000, \
+            initial_timeout=None):
+        _checkInt(min_timeout, minvalue=1, description='min_timeout')
+        _checkInt(retries, minvalue=0, description='retries')
+        _checkInt(failure_threshold, minvalue=1, description='failure_threshold')
+        self.max_timeout = max_timeout
+        self.min_timeout = min_timeout
+        self.retries = retries
+        self.backoff_ms = backoff_ms
+        self.failure_threshold = failure_threshold
+        self.open_ms = open_ms
+
+        # The timeout from the roundtrip times, and the current one, doubled for the retries
+        self._rto = max_timeout if initial_timeout is None else min(initial_timeout, max_timeout)
+        self.timeout = self._rto
+
+        self.successes = 0
+        self.failures = 0
+        self.retried = 0
+        self.timeouts = 0
+        self.corrupt = 0
+        self.rejected = 0
+        self.opened = 0
+        self.consecutive_failures = 0
+
+        # Scaled like in TCP: 8 * rtt and 4 * rttvar, so integer arithmetic keeps the precision
+        self._srtt8 = 0
+        self._rttvar4 = 0
+        self._floor = 0
+        self._samples = array('H', bytes(2 * self.WINDOW))
+        self._count = 0
+        self._open_until = None
+
+    def __repr__(self):
+        return "{}.{}<rtt={}, timeout={}, successes={}, failures={}, open={}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            self.rtt,
+            self.timeout,
+            self.successes,
+            self.failures,
+            self.is_open,
+            )
+
+    @property
+    def rtt(self):
+        # Smoothed roundtrip time in ms, None before the first sample
+        return (self._srtt8 >> 3) if self._count else None
+
+    @property
+    def rttvar(self):
+        return (self._rttvar4 >> 2) if self._count else None
+
+    @property
+    def is_open(self):
+        return self._open_until is not None and _ticks_diff(self._open_until, _ticks_ms()) > 0
+
+    def percentile(self, percent):
+        # Roundtrip time (ms) below which percent of the recent samples are, None without samples
+        number_of_samples = min(self._count, self.WINDOW)
+        if not number_of_samples:
+            return None
+        ordered = sorted(self._samples[:number_of_samples])
+        return ordered[min(number_of_samples - 1, percent * number_of_samples // 100)]
+
+    def record(self, rtt):
+        if rtt > 0xFFFF:
+            rtt = 0xFFFF
+        if self._count == 0:
+            self._srtt8 = rtt << 3
+            self._rttvar4 = rtt << 1
+        else:
+            delta = rtt - (self._srtt8 >> 3)
+            self._srtt8 += delta
+            if delta < 0:
+                delta = -delta
+            self._rttvar4 += delta - (self._rttvar4 >> 2)
+
+        self._samples[self._count % self.WINDOW] = rtt
+        self._count += 1
+        if self._count % self.WINDOW == 0:
+            # Once per window, so the floor comes down after slow samples left the window
+            self._floor = max(self._samples)
+        elif rtt > self._floor:
+            self._floor = rtt
+
+        timeout = max((self._srtt8 >> 3) + self._rttvar4, self._floor, self.min_timeout)
+        self._rto = min(timeout, self.max_timeout)
+        self.timeout = self._rto
+
+    def check(self):
+        # Raise IOError while the circuit is open
+        if self._open_until is None:
+            return
+        if _ticks_diff(self._open_until, _ticks_ms()) > 0:
+            self.rejected += 1
+            raise IOError('No communication with the instrument (skipped for {} ms after {} failures)'.format( \
+                self.open_ms, self.consecutive_failures))
+
+    def call(self, function, request, number_of_bytes_to_read):
+        # Call function(request, number_of_bytes_to_read) with the retry policy and the circuit breaker
+        self.check()
+        retries = 0 if self._open_until is not None else self.retries  # One try when half open
+        self.timeout = self._rto  # The backoff of earlier transactions does not carry over
+
+        attempt = 0
+        while True:
+            try:
+                result = function(request, number_of_bytes_to_read)
+            except (IOError, ValueError) as error:
+                if isinstance(error, ValueError):
+                    self.corrupt += 1  # Garbage is a failure too, but no reason for a longer timeout
+                elif self._count:
+                    self.timeout = min(self.timeout * 2, self.max_timeout)
+                if attempt >= retries:
+                    self._fail()
+                    raise
+                _sleep_ms(self.backoff_ms << attempt)
+                attempt += 1
+                self.retried += 1
+                continue
+
+            self.successes += 1
+            self.consecutive_failures = 0
+            self._open_until = None
+            return result
+
+    def reset(self):
+        # Close the circuit
+        self.consecutive_failures = 0
+        self._open_until = None
+
+    def _fail(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self._open_until = _ticks_add(_ticks_ms(), self.open_ms)
+            self.opened += 1
+
+#######################
+## Prepared requests ##
+#######################
+
+
+class PreparedRead():
+#    """A read request that is validated, framed and CRC'd once, and then executed many times.
+
+#    Created by Instrument.prepare_read(). The slave address is frozen when the request is
+#    prepared, so prepare it again after changing instrument.address.
+#    """
+
+    def __init__(self, instrument, functioncode, registeraddress, numberOfRegisters, request, response_size):
+        self.instrument = instrument
+        self.slaveaddress = instrument.address
+        self.functioncode = functioncode
+        self.registeraddress = registeraddress
+        self.numberOfRegisters = numberOfRegisters
+        self.request = bytes(request)
+        self.response_size = response_size
+
+    def __repr__(self):
+        return "{}.{}<address={}, functioncode={}, registeraddress={}, numberOfRegisters={}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            self.slaveaddress,
+            self.functioncode,
+            self.registeraddress,
+            self.numberOfRegisters,
+            )
+
+    def execute(self):
+        return self.execute_into([0] * self.numberOfRegisters)
+
+    def execute_into(self, values):
+        if len(values) != self.numberOfRegisters:
+            raise ValueError('The length of values does not match number of registers. ' + \
+                'Given {0!r} and {1!r}.'.format(len(values), self.numberOfRegisters))
+
+        instrument = self.instrument
+        if instrument._rxbuf is None:
+            instrument._allocateBuffers()
+
+        received = instrument._communicateInto(self.request, self.response_size)
+        _checkFrameInto(instrument._rxbuf, received, self.slaveaddress, self.functioncode)
+        _registersFromFrameInto(instrument._rxbuf, received, values)
+        return values
+
+
+class ScanPlan():
+#    """Covers a set of wanted register addresses with the fewest block reads.
+
+#    Args:
+#        * addresses: The wanted register addresses (any iterable of int).
+#        * functioncode (int): 3 (holding registers) or 4 (input registers).
+#        * max_gap (int): Largest number of unwanted registers that may be read to join two
+#          neighbouring addresses into one block. Use 0 for devices that reject reads of unmapped registers.
+#        * max_registers (int): Largest block, at most 125 (the protocol limit).
+
+#    The blocks are available as a list of (start address, number of registers) in ``plan.blocks``.
+#    Use Instrument.read_plan() to read them.
+#    """
+
+    def __init__(self, addresses, functioncode=3, max_gap=8, max_registers=_MAX_NUMBER_OF_READ_REGISTERS):
+        _checkFunctioncode(functioncode, [3, 4])
+        _checkInt(max_gap, minvalue=0, description='max_gap')
+        _checkInt(max_registers, minvalue=1, maxvalue=_MAX_NUMBER_OF_READ_REGISTERS, description='max_registers')
+
+        self.addresses = sorted(set(addresses))
+        _checkInt(len(self.addresses), minvalue=1, description='number of addresses')
+        for registeraddress in self.addresses:
+            _checkRegisteraddress(registeraddress)
+
+        self.functioncode = functioncode
+        self.max_gap = max_gap
+        self.max_registers = max_registers
+
+        self._members = _planBlocks(self.addresses, max_gap, max_registers)
+        self.blocks = [(members[0], members[-1] - members[0] + 1) for members in self._members]
+
+        # One reusable result buffer per block
+        self._buffers = [[0] * count for (start, count) in self.blocks]
+
+    def __repr__(self):
+        return "{}.{}<functioncode={}, addresses={}, blocks={!r}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            self.functioncode,
+            len(self.addresses),
+            self.blocks,
+            )
+
+class Snapshot():
+#    """One sample of Instrument.stream(). The same object is updated and yielded every period.
+
+#    Attributes:
+#        * values (dict): Register address -> value, updated in place.
+#        * timestamp (int): ticks_ms() when the read started.
+#        * sequence (int): Number of samples so far.
+#        * late_ms (int): How much later than its deadline the read started.
+#        * overruns (int): Number of deadlines skipped since the start, because the reading
+#          (or the consumer of the stream) took longer than the period.
+#        * error: The IOError or ValueError of this sample, None if it was read. The values
+#          are then those of the previous sample.
+#        * errors (int): Number of failed samples since the start.
+#    """
+
+    def __init__(self):
+        self.values = {}
+        self.timestamp = 0
+        self.sequence = 0
+        self.late_ms = 0
+        self.overruns = 0
+        self.error = None
+        self.errors = 0
+
+    def __repr__(self):
+        return "{}.{}<sequence={}, timestamp={}, late_ms={}, overruns={}, errors={}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            self.sequence,
+            self.timestamp,
+            self.late_ms,
+            self.overruns,
+            self.errors,
+            )
+
+####################
+## Bus scheduling ##
+####################
+
+
+class PollJob():
+#    """A periodic PreparedRead in a BusScheduler.
+
+#    The latest result is kept in ``values`` (the same list is reused for each poll).
+#    ``missed`` counts the deadlines that passed without a poll, ``late`` the polls that started
+#    after their deadline and ``errors`` the failed polls (the latest exception is in ``last_error``).
+#    """
+
+    def __init__(self, prepared, period_ms, callback=None):
+        self.prepared = prepared
+        self.period_ms = period_ms
+        self.callback = callback
+        self.values = [0] * prepared.numberOfRegisters
+        self.deadline = _ticks_ms()
+        self.polls = 0
+        self.late = 0
+        self.missed = 0
+        self.max_lateness = 0
+        self.errors = 0
+        self.last_error = None
+
+    def __repr__(self):
+        return "{}.{}<prepared={!r}, period_ms={}, polls={}, late={}, missed={}, errors={}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            self.prepared,
+            self.period_ms,
+            self.polls,
+            self.late,
+            self.missed,
+            self.errors,
+            )
+
+
+class BusScheduler():
+#    """Polls prepared reads of several slaves sharing one serial port, earliest deadline first.
+
+#    Transactions that are due are sent back to back, separated only by the minimum silent
+#    period. Each job keeps a fixed cadence; deadlines that pass while the bus is busy are
+#    counted as missed instead of being polled late in a burst.
+
+#    Args:
+#        * port: The serial port shared by the instruments of all jobs.
+#    """
+
+    def __init__(self, port):
+        self.port = port
+        self.jobs = []
+        self.running = False
+        self._stop_requested = False  # Set by stop() while running, cleared when run() returns
+
+    def __repr__(self):
+        return "{}.{}<port={}, jobs={}, missed={}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            self.port,
+            len(self.jobs),
+            self.missed,
+            )
+
+    @property
+    def missed(self):
+        return sum(job.missed for job in self.jobs)
+
+    def add(self, prepared, period_ms, callback=None):
+        # Poll prepared every period_ms. callback(job) is called after each successful poll.
+        if not isinstance(prepared, PreparedRead):
+            raise TypeError('The prepared request must be a PreparedRead. Given: {0!r}'.format(prepared))
+        if prepared.instrument.port != self.port:
+            raise ValueError('The instrument is on port {0!r}, but the scheduler owns port {1!r}.'.format( \
+                prepared.instrument.port, self.port))
+        _checkInt(period_ms, minvalue=1, description='period_ms')
+
+        job = PollJob(prepared, period_ms, callback)
+        self.jobs.append(job)
+        return job
+
+    def remove(self, job):
+        self.jobs.remove(job)
+
+    def run_once(self):
+        # Poll all jobs that are due, earliest deadline first.
+        # Returns the number of transactions.
+        transactions = 0
+        while True:
+            now = _ticks_ms()
+            job = self._earliestJob(now)
+            if job is None or _ticks_diff(job.deadline, now) > 0:
+                return transactions
+            self._poll(job, now)
+            transactions += 1
+
+    def run(self, duration_ms=None):
+        # Poll the jobs for duration_ms, or until stop() if None. When running is set before
+        # the thread starts (see MultiPortPoller.start()), a stop() before run() is not lost.
+        MAX_SLEEP = 100  # Check for stop() at least this often (ms)
+
+        start = _ticks_ms()
+        self.running = True
+        try:
+            while not self._stop_requested:
+                self.run_once()
+
+                now = _ticks_ms()
+                wait = self.time_until_next(now) if self.jobs else MAX_SLEEP
+                if duration_ms is not None:
+                    remaining = duration_ms - _ticks_diff(now, start)
+                    if remaining <= 0:
+                        return
+                    wait = min(wait, remaining)
+                if wait > 0:
+                    _sleep_ms(min(wait, MAX_SLEEP))
+        finally:
+            self.running = False
+            self._stop_requested = False
+
+    def stop(self):
+        # Make run() return, also from another thread
+        if self.running:
+            self._stop_requested = True
+
+    def time_until_next(self, now=None):
+        # Milliseconds until the next deadline (0 if a job is due).
+        if now is None:
+            now = _ticks_ms()
+        job = self._earliestJob(now)
+        if job is None:
+            return 0
+        return max(0, _ticks_diff(job.deadline, now))
+
+    def _earliestJob(self, now):
+        earliest = None
+        earliest_wait = 0
+        for job in self.jobs:
+            wait = _ticks_diff(job.deadline, now)
+            if earliest is None or wait < earliest_wait:
+                earliest = job
+                earliest_wait = wait
+        return earliest
+
+    def _poll(self, job, now):
+        lateness = _ticks_diff(now, job.deadline)
+        if lateness > 0:
+            job.late += 1
+            if lateness > job.max_lateness:
+                job.max_lateness = lateness
+
+        # Keep the cadence, skipping (and counting) the deadlines that already passed
+        skipped = lateness // job.period_ms
+        job.missed += skipped
+        job.deadline = _ticks_add(job.deadline, (skipped + 1) * job.period_ms)
+
+        try:
+            job.prepared.execute_into(job.values)
+        except (IOError, ValueError) as error:
+            job.errors += 1
+            job.last_error = error
+            return
+
+        job.polls += 1
+        if job.callback is not None:
+            job.callback(job)
+
+class MultiPortPoller():
+#    """Polls prepared reads on several serial ports at the same time, one thread per port.
+
+#    Each port gets a BusScheduler, run in its own thread, so a poll cycle takes as long as
+#    the slowest port instead of the sum of all ports. The results of all ports are merged
+#    into one stream of samples, in the order they were read:
+#    ``(timestamp, port, slaveaddress, functioncode, registeraddress, values)``, where
+#    timestamp is ticks_ms() and values a list.
+
+#    At most max_samples are queued; when get() or stream() do not keep up, the oldest are
+#    dropped and counted in ``dropped``. Without the _thread module the ports are polled
+#    in turn, by run().
+
+#    Args:
+#        * max_samples (int): Maximum number of queued samples.
+#    """
+
+    def __init__(self, max_samples=256):
+        _checkInt(max_samples, minvalue=1, description='max_samples')
+        self.max_samples = max_samples
+        self.schedulers = {}  # port -> BusScheduler
+        self.dropped = 0
+
+        self._samples = []
+        self._mutex = _thread.allocate_lock() if _thread is not None else None
+        self._finished = []  # Locks released by the port threads when they end
+
+    def __repr__(self):
+        return "{}.{}<ports={!r}, queued={}, dropped={}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            list(self.schedulers),
+            len(self._samples),
+            self.dropped,
+            )
+
+    def add(self, prepared, period_ms):
+        # Poll prepared every period_ms, on the scheduler of its port. Returns the PollJob.
+        port = prepared.instrument.port
+        scheduler = self.schedulers.get(port)
+        if scheduler is None:
+            scheduler = BusScheduler(port)
+            self.schedulers[port] = scheduler
+        return scheduler.add(prepared, period_ms, self._collect)
+
+    def start(self):
+        # Start one polling thread per port
+        if _thread is None:
+            raise ImportError('Threads (_thread) are not available. Use run() to poll the ports in turn.')
+        for scheduler in self.schedulers.values():
+            # Before the thread starts, so a stop() right after start() is not lost
+            scheduler._stop_requested = False
+            scheduler.running = True
+            finished = _thread.allocate_lock()
+            finished.acquire()
+            self._finished.append(finished)
+            _thread.start_new_thread(self._runPort, (scheduler, finished))
+
+    def stop(self):
+        # Stop the polling threads, and wait until they have ended
+        for scheduler in self.schedulers.values():
+            scheduler.stop()
+        while self._finished:
+            self._finished.pop().acquire()
+
+    def run(self, duration_ms):
+        # Poll all ports for duration_ms, in threads if available
+        if _thread is not None:
+            self.start()
+            _sleep_ms(duration_ms)
+            self.stop()
+            return
+
+        start = _ticks_ms()
+        while _ticks_diff(_ticks_ms(), start) < duration_ms:
+            wait = duration_ms - _ticks_diff(_ticks_ms(), start)
+            for scheduler in self.schedulers.values():
+                scheduler.run_once()
+                wait = min(wait, scheduler.time_until_next())
+            if wait > 0:
+                _sleep_ms(wait)
+
+    def get(self):
+        # Take the queued samples, oldest first
+        if self._mutex is not None:
+            self._mutex.acquire()
+        samples = self._samples
+        self._samples = []
+        if self._mutex is not None:
+            self._mutex.release()
+        return samples
+
+    def stream(self, poll_ms=1):
+        # Generator yielding the samples as they arrive, while the threads poll
+        while True:
+            samples = self.get()
+            if not samples:
+                _sleep_ms(poll_ms)
+            for sample in samples:
+                yield sample
+
+    def _runPort(self, scheduler, finished):
+        try:
+            scheduler.run()
+        finally:
+            finished.release()
+
+    def _collect(self, job):
+        # PollJob callback, in the thread of the port
+        prepared = job.prepared
+        if self._mutex is not None:
+            self._mutex.acquire()
+        if len(self._samples) >= self.max_samples:
+            self._samples.pop(0)
+            self.dropped += 1
+        self._samples.append((_ticks_ms(), prepared.instrument.port, prepared.slaveaddress, \
+            prepared.functioncode, prepared.registeraddress, list(job.values)))
+        if self._mutex is not None:
+            self._mutex.release()
+
+###################
+## Bus discovery ##
+###################
+
+
+def discover(port, addresses=range(1, 248), baudrates=(BAUDRATE,), parities=(PARITY,), \
+        timeout=None, registeraddress=0, transport_class=UARTTransport, transport=None):
+#    """Find the slaves on a bus, by probing each address with a read of one holding register.
+
+#    Every combination of baudrate and parity is tried, with a new transport_class(port, ...)
+#    (UARTTransport or SerialTransport). A given transport is used as it is, for all settings,
+#    and its own read timeout applies: timeout has no effect then.
+
+#    The timeout defaults to the time to send the probe plus a few silent periods, so a full
+#    scan of 247 addresses takes about 7 s at 9600 Baud, and less at higher baudrates. Give a
+#    longer timeout for slow slaves.
+
+#    Returns a list of (slaveaddress, baudrate, parity, reply), where reply is SCAN_VALID,
+#    SCAN_EXCEPTION or SCAN_GARBAGE. Addresses without reply are left out.
+
+#    The timing settings of the port's Bus (baudrate, silent period) are restored afterwards.
+#    """
+    # The probing instruments set the baudrate of the shared bus, restore it afterwards
+    bus = _getBus(port)
+    saved = (bus.baudrate, bus.silent_period_us, bus.char_gap_us)
+    try:
+        return _discover(port, addresses, baudrates, parities, timeout, registeraddress, transport_class, transport)
+    finally:
+        bus.baudrate, bus.silent_period_us, bus.char_gap_us = saved
+
+
+def _discover(port, addresses, baudrates, parities, timeout, registeraddress, transport_class, transport):
+    PROBE_FUNCTIONCODE = 3
+    PROBE_RESPONSE_SIZE = 7  # Read of one register
+    PROBE_SILENT_PERIODS = 5  # Time for the slave to answer
+
+    found = []
+    for baudrate in baudrates:
+        probe_timeout = timeout
+        if probe_timeout is None:
+            probe_timeout = int(_calculate_transmission_time(baudrate, _READ_REQUEST_SIZE) + \
+                PROBE_SILENT_PERIODS * _calculate_minimum_silent_period(baudrate)) + 1
+
+        for parity in parities:
+            port_transport = transport
+            if port_transport is None:
+                port_transport = transport_class(port, baudrate, parity=parity, timeout=probe_timeout)
+            instrument = Instrument(port, 1, transport=port_transport, baudrate=baudrate, \
+                parity=parity, timeout=probe_timeout)
+            payloadToSlave = _numToTwoByteArray(registeraddress) + _numToTwoByteArray(1)
+
+            try:
+                for slaveaddress in addresses:
+                    _checkSlaveaddress(slaveaddress)
+                    instrument.address = slaveaddress
+                    request = _embedPayload(slaveaddress, MODE_RTU, PROBE_FUNCTIONCODE, payloadToSlave)
+
+                    try:
+                        response = instrument._communicate(request, PROBE_RESPONSE_SIZE)
+                    except IOError:
+                        continue
+                    found.append((slaveaddress, baudrate, parity, \
+                        _classifyResponse(response, slaveaddress, PROBE_FUNCTIONCODE)))
+            finally:
+                if transport is None and hasattr(port_transport, 'close'):
+                    port_transport.close()
+
+    return found
+
+
+def _classifyResponse(response, slaveaddress, functioncode):
+    # SCAN_VALID, SCAN_EXCEPTION or SCAN_GARBAGE
+    try:
+        _checkFrameInto(response, len(response), slaveaddress, functioncode)
+    except ValueError:
+        if len(response) == _EXCEPTION_RESPONSE_SIZE and response[0] == slaveaddress and \
+                response[1] == functioncode | 0x80 and _crc16(response, 0, len(response)) == 0:
+            return SCAN_EXCEPTION
+        return SCAN_GARBAGE
+    return SCAN_VALID
+
 ####################
 # Payload handling #
 ####################
 
 
+def _createPayload(functioncode, registeraddress, value, numberOfRegisters, signed, payloadformat, \
+        writeaddress=None, numberOfBits=1):
+    # Validate a command and build the payload to the slave.
+    # Returns the payload and the (possibly defaulted) payload format.
+    # For functioncode 23, registeraddress and numberOfRegisters are the read range,
+    # and value is written starting at writeaddress.
+    # For functioncodes 1, 2 and 15 with the 'bits' payload format, numberOfBits are
+    # read/written and the value is packed in a bytearray.
+    ALL_ALLOWED_FUNCTIONCODES = list(range(1, 7)) + [15, 16, 23]  # To comply with both Python2 and Python3
+    MAX_NUMBER_OF_REGISTERS = 255
+
+    ## Check input values ##
+    _checkFunctioncode(functioncode, ALL_ALLOWED_FUNCTIONCODES)  # Note: The calling facade functions should validate this
+    _checkRegisteraddress(registeraddress)
+    _checkInt(numberOfRegisters, minvalue=1, maxvalue=MAX_NUMBER_OF_REGISTERS, description='number of registers')
+    _checkBool(signed, description='signed')
+
+    if payloadformat is not None:
+        if payloadformat not in _ALL_PAYLOADFORMATS:
+            raise ValueError('Wrong payload format variable. Given: {0!r}'.format(payloadformat))
+
+    ## Check combinations of input parameters ##
+    numberOfRegisterBytes = numberOfRegisters * _NUMBER_OF_BYTES_PER_REGISTER
+
+                # Payload format
+    if functioncode in [3, 4, 6, 16, 23] and payloadformat is None:
+        payloadformat = _PAYLOADFORMAT_REGISTER
+
+    if functioncode in [3, 4, 6, 16, 23]:
+        if payloadformat not in [_PAYLOADFORMAT_REGISTER, _PAYLOADFORMAT_REGISTERS]:
+            raise ValueError('The payload format is unknown. Given format: {0!r}, functioncode: {1!r}.'.\
+                format(payloadformat, functioncode))
+    elif functioncode in [1, 2, 15]:
+        if payloadformat not in [None, _PAYLOADFORMAT_BITS]:
+            raise ValueError('The payload format given is not allowed for this function code. ' + \
+                'Given format: {0!r}, functioncode: {1!r}.'.format(payloadformat, functioncode))
+    else:
+        if payloadformat is not None:
+            raise ValueError('The payload format given is not allowed for this function code. ' + \
+                'Given format: {0!r}, functioncode: {1!r}.'.format(payloadformat, functioncode))
+
+                # Signed 
+    if signed:
+        if payloadformat not in [_PAYLOADFORMAT_REGISTER, _PAYLOADFORMAT_REGISTERS]:
+            raise ValueError('The "signed" parameter can not be used for this data format. ' + \
+                'Given format: {0!r}.'.format(payloadformat))
+
+                # Number of registers
+    if functioncode not in [3, 4, 16, 23] and numberOfRegisters != 1:
+        raise ValueError('The numberOfRegisters is not valid for this function code. ' + \
+            'NumberOfRegisters: {0!r}, functioncode {1}.'.format(numberOfRegisters, functioncode))
+
+    if functioncode == 16 and payloadformat == _PAYLOADFORMAT_REGISTER and numberOfRegisters != 1:
+        raise ValueError('Wrong numberOfRegisters when writing to a ' + \
+            'single register. Given {0!r}.'.format(numberOfRegisters))
+        # Note: For function code 16 there is checking also in the content conversion functions.
+
+                # Value
+    if functioncode in [5, 6, 15, 16, 23] and value is None:
+        raise ValueError('The input value is not valid for this function code. ' + \
+            'Given {0!r} and {1}.'.format(value, functioncode))
+
+    if functioncode == 16 and payloadformat in [_PAYLOADFORMAT_REGISTER]:
+        _checkNumerical(value, description='input value')
+
+    if functioncode == 6 and payloadformat == _PAYLOADFORMAT_REGISTER:
+        _checkNumerical(value, description='input value')
+
+                # Value for string
+    if functioncode == 16 and payloadformat == _PAYLOADFORMAT_REGISTERS:
+        if not isinstance(value, (list, array)):
+            raise TypeError('The value parameter must be a list or an array. Given {0!r}.'.format(value))
+
+        if len(value) != numberOfRegisters:
+            raise ValueError('The list length does not match number of registers. ' + \
+                'List: {0!r},  Number of registers: {1!r}.'.format(value, numberOfRegisters))
+
+                # Number of bits
+    if payloadformat == _PAYLOADFORMAT_BITS:
+        maxvalue = _MAX_NUMBER_OF_WRITE_BITS if functioncode == 15 else _MAX_NUMBER_OF_READ_BITS
+        _checkInt(numberOfBits, minvalue=1, maxvalue=maxvalue, description='number of bits')
+    elif numberOfBits != 1:
+        raise ValueError('The numberOfBits is not valid for this payload format. ' + \
+            'NumberOfBits: {0!r}, payload format {1!r}.'.format(numberOfBits, payloadformat))
+
+    if functioncode == 15 and payloadformat == _PAYLOADFORMAT_BITS:
+        _checkString(value, minlength=_numberOfBytesForBits(numberOfBits), \
+            maxlength=_numberOfBytesForBits(numberOfBits), description='packed bits')
+
+    if functioncode == 23:
+        if payloadformat != _PAYLOADFORMAT_REGISTERS:
+            raise ValueError('Wrong payload format for functioncode 23. Given: {0!r}'.format(payloadformat))
+
+        if not isinstance(value, (list, array)):
+            raise TypeError('The value parameter must be a list or an array. Given {0!r}.'.format(value))
+
+        _checkRegisteraddress(writeaddress)
+        _checkInt(len(value), minvalue=1, maxvalue=_MAX_NUMBER_OF_READ_WRITE_WRITE_REGISTERS, \
+            description='number of registers to write')
+
+    ## Build payload to slave ##
+    if functioncode in [1, 2]:
+        payloadToSlave = _numToTwoByteArray(registeraddress) + \
+                        _numToTwoByteArray(numberOfBits)
+
+    elif functioncode in [3, 4]:
+        payloadToSlave = _numToTwoByteArray(registeraddress) + \
+                        _numToTwoByteArray(numberOfRegisters)
+
+    elif functioncode == 5:
+        payloadToSlave = _numToTwoByteArray(registeraddress) + \
+                        _createBitpattern(functioncode, value)
+
+    elif functioncode == 6:
+        payloadToSlave = _numToTwoByteArray(registeraddress) + \
+                        _numToTwoByteArray(value, signed=signed)
+
+    elif functioncode == 15 and payloadformat == _PAYLOADFORMAT_BITS:
+        payloadToSlave = _numToTwoByteArray(registeraddress) + \
+                        _numToTwoByteArray(numberOfBits) + \
+                        _numToOneByteArray(len(value)) + \
+                        _maskBits(value, numberOfBits)
+
+    elif functioncode == 15:
+        payloadToSlave = _numToTwoByteArray(registeraddress) + \
+                        _numToTwoByteArray(_NUMBER_OF_BITS) + \
+                        _numToOneByteArray(_NUMBER_OF_BYTES_FOR_ONE_BIT) + \
+                        _createBitpattern(functioncode, value)
+
+    elif functioncode == 16:
+        if payloadformat == _PAYLOADFORMAT_REGISTER:
+            registerdata = _numToTwoByteArray(value, signed=signed)
+        elif payloadformat == _PAYLOADFORMAT_REGISTERS:
+            registerdata = _valuelistToBytestring(value, numberOfRegisters, signed)
+
+        assert len(registerdata) == numberOfRegisterBytes
+        payloadToSlave = _numToTwoByteArray(registeraddress) + \
+                        _numToTwoByteArray(numberOfRegisters) + \
+                        _numToOneByteArray(numberOfRegisterBytes) + \
+                        registerdata
+
+    elif functioncode == 23:
+        numberOfWriteRegisters = len(value)
+        payloadToSlave = _numToTwoByteArray(registeraddress) + \
+                        _numToTwoByteArray(numberOfRegisters) + \
+                        _numToTwoByteArray(writeaddress) + \
+                        _numToTwoByteArray(numberOfWriteRegisters) + \
+                        _numToOneByteArray(numberOfWriteRegisters * _NUMBER_OF_BYTES_PER_REGISTER) + \
+                        _valuelistToBytestring(value, numberOfWriteRegisters, signed)
+
+    return payloadToSlave, payloadformat
+
+
+def _interpretPayload(functioncode, registeraddress, value, numberOfRegisters, signed, payloadformat, payloadFromSlave, \
+        numberOfBits=1):
+    # Check the response payload of a command built by _createPayload() and calculate the return value.
+    numberOfRegisterBytes = numberOfRegisters * _NUMBER_OF_BYTES_PER_REGISTER
+
+    ## Check the contents in the response payload ##
+    if functioncode in [1, 2, 3, 4, 23]:
+        _checkResponseByteCount(payloadFromSlave)  # response byte count
+
+    if functioncode in [5, 6, 15, 16]:
+        _checkResponseRegisterAddress(payloadFromSlave, registeraddress)  # response register address
+
+    if functioncode == 5:
+        _checkResponseWriteData(payloadFromSlave, _createBitpattern(functioncode, value))  # response write data
+
+    if functioncode == 6:
+        _checkResponseWriteData(payloadFromSlave, \
+            _numToTwoByteArray(value, signed=signed))  # response write data
+
+    if functioncode == 15:
+        _checkResponseNumberOfRegisters(payloadFromSlave, numberOfBits)  # response number of bits
+
+    if functioncode == 16:
+        _checkResponseNumberOfRegisters(payloadFromSlave, numberOfRegisters)  # response number of registers
+
+    ## Calculate return value ##
+    if functioncode in [1, 2] and payloadformat == _PAYLOADFORMAT_BITS:
+        registerdata = payloadFromSlave[_NUMBER_OF_BYTES_BEFORE_REGISTERDATA:]
+        if len(registerdata) != _numberOfBytesForBits(numberOfBits):
+            raise ValueError('The registerdata length does not match number of bits. ' + \
+                'Given {0!r} and {1!r}.'.format(len(registerdata), numberOfBits))
+
+        return _maskBits(registerdata, numberOfBits)
+
+    if functioncode in [1, 2]:
+        registerdata = payloadFromSlave[_NUMBER_OF_BYTES_BEFORE_REGISTERDATA:]
+        if len(registerdata) != _NUMBER_OF_BYTES_FOR_ONE_BIT:
+            raise ValueError('The registerdata length does not match NUMBER_OF_BYTES_FOR_ONE_BIT. ' + \
+                'Given {0}.'.format(len(registerdata)))
+
+        return _bitResponseToValue(registerdata)
+
+    if functioncode in [3, 4, 23]:
+        registerdata = payloadFromSlave[_NUMBER_OF_BYTES_BEFORE_REGISTERDATA:]
+        if len(registerdata) != numberOfRegisterBytes:
+            raise ValueError('The registerdata length does not match number of register bytes. ' + \
+                'Given {0!r} and {1!r}.'.format(len(registerdata), numberOfRegisterBytes))
+
+        elif payloadformat == _PAYLOADFORMAT_REGISTERS:
+            return _bytearrayToValuelist(registerdata, numberOfRegisters, signed)
+
+        elif payloadformat == _PAYLOADFORMAT_REGISTER:
+            return _twoByteStringToNum(registerdata, signed=signed)
+
+        raise ValueError('Wrong payloadformat for return value generation. ' + \
+            'Given {0}'.format(payloadformat))
+
+
 def _embedPayload(slaveaddress, mode, functioncode, payloaddata):
     _checkSlaveaddress(slaveaddress)
     _checkMode(mode)
@@ -503,6 +2399,44 @@ def _extractPayload(response, slaveaddress, mode, functioncode):
 
     payload = response[firstDatabyteNumber:lastDatabyteNumber]
     return bytearray(payload)
+
+
+def _checkResponseFrame(buffer, length, request):
+    # Raise ValueError for a response that is corrupt (CRC) or does not belong to the request.
+    # Exception responses pass.
+    if length < _EXCEPTION_RESPONSE_SIZE or _crc16(buffer, 0, length) != 0:  # 0 over a frame with its CRC
+        raise ValueError('Corrupt response (checksum error or too short): {!r}'.format(bytes(buffer[:length])))
+    if buffer[0] != request[0] or buffer[1] & 0x7F != request[1]:
+        raise ValueError('The response does not match the request: {!r}'.format(bytes(buffer[:length])))
+
+
+def _checkFrameInto(buffer, length, slaveaddress, functioncode):
+    # Validate a response frame received into a preallocated buffer, without slicing it.
+    # Same checks as _extractPayload(). The payload is buffer[2:length - 2].
+    MINIMAL_RESPONSE_LENGTH_RTU = 5
+    BITNUMBER_FUNCTIONCODE_ERRORINDICATION = 7
+
+    if length < MINIMAL_RESPONSE_LENGTH_RTU:
+        raise ValueError('Too short Modbus RTU response (minimum length {} bytes). Response: {!r}'.format( \
+            MINIMAL_RESPONSE_LENGTH_RTU, bytes(buffer[:length])))
+
+    calculatedChecksum = _crc16(buffer, 0, length - 2)
+    receivedChecksum = buffer[length - 2] | (buffer[length - 1] << 8)
+    if receivedChecksum != calculatedChecksum:
+        raise ValueError('Checksum error in {} mode: {:#06x} instead of {:#06x} . The response is: {!r}'.format( \
+            MODE_RTU, receivedChecksum, calculatedChecksum, bytes(buffer[:length])))
+
+    if buffer[0] != slaveaddress:
+        raise ValueError('Wrong return slave address: {} instead of {}. The response is: {!r}'.format( \
+            buffer[0], slaveaddress, bytes(buffer[:length])))
+
+    receivedFunctioncode = buffer[1]
+    if receivedFunctioncode == functioncode | (1 << BITNUMBER_FUNCTIONCODE_ERRORINDICATION):  # No _setBitOn(), its checks allocate
+        raise ValueError('The slave is indicating an error. The response is: {!r}'.format(bytes(buffer[:length])))
+
+    elif receivedFunctioncode != functioncode:
+        raise ValueError('Wrong functioncode: {} instead of {}. The response is: {!r}'.format( \
+            receivedFunctioncode, functioncode, bytes(buffer[:length])))
 ############################################
 ## Serial communication utility functions ##
 ############################################
@@ -528,7 +2462,7 @@ def _predictResponseSize(mode, functioncode, payloadToSlave):
     if functioncode in [5, 6, 15, 16]:
         response_payload_size = NUMBER_OF_PAYLOAD_BYTES_IN_WRITE_CONFIRMATION
 
-    elif functioncode in [1, 2, 3, 4]:
+    elif functioncode in [1, 2, 3, 4, 23]:
         given_size = _twoByteStringToNum(payloadToSlave[2:4])
         if functioncode == 1 or functioncode == 2:
             # Algorithm from MODBUS APPLICATION PROTOCOL SPECIFICATION V1.1b
@@ -536,7 +2470,7 @@ def _predictResponseSize(mode, functioncode, payloadToSlave):
             response_payload_size = NUMBER_OF_PAYLOAD_BYTES_FOR_BYTECOUNTFIELD + \
                                     number_of_inputs // 8 + (1 if number_of_inputs % 8 else 0)
 
-        elif functioncode == 3 or functioncode == 4:
+        elif functioncode == 3 or functioncode == 4 or functioncode == 23:
             number_of_registers = given_size
             response_payload_size = NUMBER_OF_PAYLOAD_BYTES_FOR_BYTECOUNTFIELD + \
                                     number_of_registers * _NUMBER_OF_BYTES_PER_REGISTER
@@ -551,6 +2485,45 @@ def _predictResponseSize(mode, functioncode, payloadToSlave):
         NUMBER_OF_RTU_RESPONSE_ENDBYTES
 
 
+def _planBlocks(addresses, max_gap, max_registers):
+    # Group sorted, unique register addresses into the fewest blocks where each block spans
+    # at most max_registers registers and has no hole larger than max_gap registers.
+    # Extending the current block as long as possible is optimal for this problem.
+    # Returns a list with the wanted addresses of each block.
+    groups = []
+    members = None
+    for registeraddress in addresses:
+        if members is not None and \
+                registeraddress - members[-1] - 1 <= max_gap and \
+                registeraddress - members[0] < max_registers:
+            members.append(registeraddress)
+        else:
+            members = [registeraddress]
+            groups.append(members)
+    return groups
+
+
+def _remainingResponseSize(functioncode, number_of_bytes_to_read):
+    # Number of response bytes that follow the header (slave address and functioncode).
+    # Returns None when it is given by the byte count field, that must be read first.
+    BITNUMBER_FUNCTIONCODE_ERRORINDICATION = 7
+
+    if functioncode & (1 << BITNUMBER_FUNCTIONCODE_ERRORINDICATION):
+        return _EXCEPTION_RESPONSE_SIZE - _RESPONSE_HEADER_SIZE
+
+    if number_of_bytes_to_read is not None:
+        return number_of_bytes_to_read - _RESPONSE_HEADER_SIZE
+
+    if functioncode in (5, 6, 15, 16):
+        return _WRITE_CONFIRMATION_SIZE - _RESPONSE_HEADER_SIZE
+
+    if functioncode in (1, 2, 3, 4, 23):
+        return None
+
+    # Unknown functioncode, read until the inter-frame gap
+    return _MAX_RTU_FRAME_SIZE - _RESPONSE_HEADER_SIZE
+
+
 def _calculate_minimum_silent_period(baudrate):
     _checkNumerical(baudrate, minvalue=1, description='baudrate')  # Avoid division by zero
 
@@ -560,6 +2533,17 @@ def _calculate_minimum_silent_period(baudrate):
     bittime = 1000 / float(baudrate)
     return bittime * BITTIMES_PER_CHARACTERTIME * MINIMUM_SILENT_CHARACTERTIMES
 
+
+def _calculate_transmission_time(baudrate, number_of_bytes):
+    # Time in ms to send number_of_bytes characters
+    BITTIMES_PER_CHARACTERTIME = 11
+    return 1000 / float(baudrate) * BITTIMES_PER_CHARACTERTIME * number_of_bytes
+
+
+def _calculate_inter_frame_timeout(baudrate):
+    # The UART inter-character timeout (whole ms) that ends a read at the 3.5 character gap
+    return int(_calculate_minimum_silent_period(baudrate)) + 1
+
 ##############################
 # String and num conversions #
 ##############################
@@ -604,43 +2588,87 @@ def _twoByteStringToNum(bytearray, signed=False):
 
     return fullregister
     
-def _valuelistToBytestring(valuelist, numberOfRegisters):
-    MINVALUE = 0
-    MAXVALUE = 65535
+def _valuelistToBytestring(valuelist, numberOfRegisters, signed=False):
+    if signed:
+        MINVALUE = -32768
+        MAXVALUE = 32767
+        formatcode = 'h'  # (Signed) short (2 bytes)
+    else:
+        MINVALUE = 0
+        MAXVALUE = 65535
+        formatcode = 'H'  # Unsigned short (2 bytes)
 
     _checkInt(numberOfRegisters, minvalue=1, description='number of registers')
 
-    if not isinstance(valuelist, list):
-        raise TypeError('The valuelist parameter must be a list. Given {0!r}.'.format(valuelist))
+    if not isinstance(valuelist, (list, array)):
+        raise TypeError('The valuelist parameter must be a list or an array. Given {0!r}.'.format(valuelist))
 
-    for value in valuelist:
-        _checkInt(value, minvalue=MINVALUE, maxvalue=MAXVALUE, description='elements in the input value list')
+    # The elements of an array are already integers of the right size
+    if isinstance(valuelist, list):
+        for value in valuelist:
+            if not isinstance(value, int) or value < MINVALUE or value > MAXVALUE:
+                _checkInt(value, minvalue=MINVALUE, maxvalue=MAXVALUE, description='elements in the input value list')
 
     _checkInt(len(valuelist), minvalue=numberOfRegisters, maxvalue=numberOfRegisters, \
         description='length of the list')
 
-    numberOfBytes = _NUMBER_OF_BYTES_PER_REGISTER * numberOfRegisters
-
-    bytearray_temp = bytearray(0)
-    for value in valuelist:
-        bytearray_temp += _numToTwoByteArray(value, signed=False)
+    # Pack all registers with a single (big-endian) struct call
+    formatstring = '>{}{}'.format(numberOfRegisters, formatcode)
+    try:
+        result = struct.pack(formatstring, *valuelist)
+    except:
+        errortext = 'The values to send are probably out of range, as the list-to-bytearray conversion failed.'
+        errortext += ' Values: {0!r} Struct format code is: {1}'
+        raise ValueError(errortext.format(valuelist, formatstring))
 
-    assert len(bytearray_temp) == numberOfBytes
-    return bytearray_temp
+    return bytearray(result)
 
 
-def _bytearrayToValuelist(bytearray, numberOfRegisters):
+def _bytearrayToValuelist(bytearray, numberOfRegisters, signed=False):
     _checkInt(numberOfRegisters, minvalue=1, description='number of registers')
     numberOfBytes = _NUMBER_OF_BYTES_PER_REGISTER * numberOfRegisters
     _checkString(bytearray, 'byte string', minlength=numberOfBytes, maxlength=numberOfBytes)
 
-    values = []
+    # Unpack all registers with a single (big-endian) struct call
+    formatstring = '>{}{}'.format(numberOfRegisters, 'h' if signed else 'H')
+    return list(struct.unpack(formatstring, bytearray))
+
+
+def _registersFromFrameInto(buffer, length, values, signed=False):
+    # Decode the register data of a functioncode 3/4 response frame (in buffer[:length])
+    # into the list or array values, in place.
+    numberOfRegisters = len(values)
+    numberOfRegisterBytes = numberOfRegisters * _NUMBER_OF_BYTES_PER_REGISTER
+
+    if buffer[2] != length - 5:
+        raise ValueError('Wrong given number of bytes in the response: {0}, but counted is {1}.'.format( \
+            buffer[2], length - 5))
+
+    if buffer[2] != numberOfRegisterBytes:
+        raise ValueError('The registerdata length does not match number of register bytes. ' + \
+            'Given {0!r} and {1!r}.'.format(buffer[2], numberOfRegisterBytes))
+
+    # CPython arrays: copy the big-endian data as is and byteswap in place
+    if getattr(values, 'typecode', None) in ('H', 'h'):
+        memoryview(values).cast('B')[:] = memoryview(buffer)[3:3 + numberOfRegisterBytes]
+        if sys.byteorder == 'little':
+            values.byteswap()
+        return
+
+    offset = 3
     for i in range(numberOfRegisters):
-        offset = _NUMBER_OF_BYTES_PER_REGISTER * i
-        substring = bytearray[offset : offset + _NUMBER_OF_BYTES_PER_REGISTER]
-        values.append(_twoByteStringToNum(substring))
+        value = (buffer[offset] << 8) | buffer[offset + 1]
+        if signed and value & 0x8000:
+            value -= 0x10000
+        values[i] = value
+        offset += _NUMBER_OF_BYTES_PER_REGISTER
+
 
-    return values
+def _buffersEqual(first, second, length):
+    for i in range(length):
+        if first[i] != second[i]:
+            return False
+    return True
 
 
 def _pack(formatstring, value):
@@ -685,8 +2713,8 @@ def _hexlify(bytearray):
 def _bitResponseToValue(bytearray):
     _checkString(bytearray, description='bytearray', minlength=1, maxlength=1)
 
-    RESPONSE_ON  = '\x01'
-    RESPONSE_OFF = '\x00'
+    RESPONSE_ON  = b'\x01'
+    RESPONSE_OFF = b'\x00'
 
     if bytearray == RESPONSE_ON:
         return 1
@@ -702,15 +2730,38 @@ def _createBitpattern(functioncode, value):
 
     if functioncode == 5:
         if value == 0:
-            return '\x00\x00'
+            return bytearray(b'\x00\x00')
         else:
-            return '\xff\x00'
+            return bytearray(b'\xff\x00')
 
     elif functioncode == 15:
         if value == 0:
-            return '\x00'
+            return bytearray(b'\x00')
         else:
-            return '\x01'  # Is this correct??
+            return bytearray(b'\x01')
+
+
+def _numberOfBytesForBits(numberOfBits):
+    return numberOfBits // 8 + (1 if numberOfBits % 8 else 0)
+
+
+def _packBits(bits):
+    # Pack a list of 0/1 into a bytearray, the first bit in the least significant bit of the first byte
+    packed = bytearray(_numberOfBytesForBits(len(bits)))
+    for i in range(len(bits)):
+        value = bits[i]
+        _checkInt(value, minvalue=0, maxvalue=1, description='bit value')
+        if value:
+            packed[i >> 3] |= 1 << (i & 7)
+    return packed
+
+
+def _maskBits(packed, numberOfBits):
+    # Copy of the packed bits, with the unused bits of the last byte cleared
+    result = bytearray(packed)
+    if numberOfBits % 8:
+        result[-1] &= (1 << (numberOfBits % 8)) - 1
+    return result
 
 
 ####################
@@ -754,6 +2805,14 @@ _CRC16TABLE = (
     33217, 32897, 16448)
 
 
+def _crc16(buffer, start, end):
+    # CRC16 of buffer[start:end] as an int, without slicing the buffer
+    register = 0xFFFF
+    for i in range(start, end):
+        register = (register >> 8) ^ _CRC16TABLE[(register ^ buffer[i]) & 0xFF]
+    return register
+
+
 def _calculateCrcString(inputstring):
     # Preload a 16-bit register with ones
     register = 0xFFFF
@@ -803,6 +2862,12 @@ def _checkSlaveaddress(slaveaddress):
     _checkInt(slaveaddress, SLAVEADDRESS_MIN, SLAVEADDRESS_MAX, description='slaveaddress')
 
 
+def _checkBroadcastFunctioncode(functioncode):
+    if functioncode not in _BROADCAST_FUNCTIONCODES:
+        raise ValueError('Functioncode {0} can not be broadcast (slave address 0), allowed values are {1!r}'.format( \
+            functioncode, _BROADCAST_FUNCTIONCODES))
+
+
 def _checkRegisteraddress(registeraddress):
     REGISTERADDRESS_MAX = 0xFFFF
     REGISTERADDRESS_MIN = 0
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+# asyncio/uasyncio version of minimalmodbus.Instrument.
+# The silent period, the write, the local echo and the response are awaited,
+# so other coroutines keep running during a Modbus transaction.
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from minimalmodbus import MODE_RTU, BAUDRATE, TIMEOUT, BROADCAST_DELAY, _BROADCAST_ADDRESS, _getBus, \
+    _sleep_us, _calculate_transmission_time, \
+    _checkBroadcastFunctioncode, \
+    _createPayload, _interpretPayload, _embedPayload, _extractPayload, _predictResponseSize, \
+    _remainingResponseSize, _checkFunctioncode, _checkInt, _checkBool, _checkNumerical, _checkString, \
+    _PAYLOADFORMAT_REGISTERS, _RESPONSE_HEADER_SIZE, _NUMBER_OF_CRC_BYTES
+
+# One asyncio lock per port (or per stream, without a port name), shared by the instruments on it
+_LOCKS = {}
+
+
+class AsyncInstrument():
+#    """Instrument class for talking to a slave via Modbus RTU over an asyncio stream.
+
+#    Args:
+#        * stream: Stream to read from, with ``await readexactly(n)``. On MicroPython use
+#          ``uasyncio.StreamReader(uart)``.
+#        * slaveaddress (int): Slave address in the range 1 to 247, or 0 to broadcast writes.
+#        * writer: Stream to write to, with ``write(data)`` and ``await drain()``. Defaults to ``stream``.
+#        * port: Name of the port. Instruments on the same port (or, without a port, the same writer)
+#          share one lock, so their transactions do not overlap, and the silent period bookkeeping.
+#        * baudrate (int): Used for the silent period between frames.
+#        * timeout (int): Response timeout in ms.
+#    """
+
+    def __init__(self, stream, slaveaddress, writer=None, port=None, baudrate=BAUDRATE, timeout=TIMEOUT):
+        self.stream = stream
+        self.writer = stream if writer is None else writer
+        self.port = port
+        self.bus = _getBus(port)  # Only for the silent period, the asyncio lock of the port serializes the transactions
+        self.bus.set_baudrate(baudrate)
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.broadcast_delay = BROADCAST_DELAY
+        self.address = slaveaddress
+        self.mode = MODE_RTU
+        self.handle_local_echo = False
+
+        # One transaction at a time on the port, for all instruments on it
+        self._lock = _getLock(port if port is not None else self.writer)
+
+    def __repr__(self):
+        return "{}.{}<id=0x{:x}, address={}, mode={}, port={}, baudrate={}, timeout={}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            id(self),
+            self.address,
+            self.mode,
+            self.port,
+            self.baudrate,
+            self.timeout,
+            )
+
+    ######################################
+    ## Methods for talking to the slave ##
+    ######################################
+
+    async def write_register(self, registeraddress, value, signed=False):
+        _checkBool(signed, description='signed')
+        _checkNumerical(value, description='input value')
+
+        await self._genericCommand(6, registeraddress, value, signed=signed)
+
+    async def read_registers(self, registeraddress, numberOfRegisters, functioncode=3):
+        _checkFunctioncode(functioncode, [3, 4])
+        _checkInt(numberOfRegisters, minvalue=1, description='number of registers')
+        return await self._genericCommand(functioncode, registeraddress, \
+            numberOfRegisters=numberOfRegisters, payloadformat=_PAYLOADFORMAT_REGISTERS)
+
+    async def write_registers(self, registeraddress, values):
+        if not isinstance(values, list):
+            raise TypeError('The "values parameter" must be a list. Given: {0!r}'.format(values))
+        _checkInt(len(values), minvalue=1, description='length of input list')
+
+        await self._genericCommand(16, registeraddress, values, numberOfRegisters=len(values), \
+            payloadformat=_PAYLOADFORMAT_REGISTERS)
+
+    ##########################################
+    ## Communication implementation details ##
+    ##########################################
+
+    async def _genericCommand(self, functioncode, registeraddress, value=None, \
+            numberOfRegisters=1, signed=False, payloadformat=None):
+        payloadToSlave, payloadformat = _createPayload(functioncode, registeraddress, value, \
+            numberOfRegisters, signed, payloadformat)
+
+        payloadFromSlave = await self._performCommand(functioncode, payloadToSlave)
+
+        if payloadFromSlave is None:  # Broadcast
+            return None
+
+        return _interpretPayload(functioncode, registeraddress, value, \
+            numberOfRegisters, signed, payloadformat, payloadFromSlave)
+
+    async def _performCommand(self, functioncode, payloadToSlave):
+        request = _embedPayload(self.address, self.mode, functioncode, payloadToSlave)
+
+        if self.address == _BROADCAST_ADDRESS:
+            _checkBroadcastFunctioncode(functioncode)
+            async with self._lock:
+                await self._broadcast(request)
+            return None
+
+        try:
+            number_of_bytes_to_read = _predictResponseSize(self.mode, functioncode, payloadToSlave)
+        except ValueError:
+            number_of_bytes_to_read = None
+
+        async with self._lock:
+            response = await self._communicate(request, number_of_bytes_to_read)
+
+        return _extractPayload(response, self.address, self.mode, functioncode)
+
+    async def _broadcast(self, request):
+        # Nothing is read back. The next request on the port waits for the turnaround delay.
+        await self._write(request)
+
+        if self.handle_local_echo:
+            try:
+                await self._read(len(request))
+            except asyncio.TimeoutError:
+                raise IOError('Local echo handling is enabled, but there was no local echo')
+
+        transmission_time = _calculate_transmission_time(self.baudrate, len(request))
+        self.bus.mark_idle(int((transmission_time + self.broadcast_delay) * 1000))
+
+    async def _write(self, request):
+        _checkString(request, minlength=1, description='request')
+
+        # Wait to make sure 3.5 character times have passed. Less than a ms is not worth
+        # a trip through the event loop, which would round it up.
+        wait = self.bus.time_until_idle()
+        if wait >= 1000:
+            await asyncio.sleep(wait / 1000000)
+        elif wait > 0:
+            _sleep_us(wait)
+
+        self.writer.write(request)
+        await self.writer.drain()
+
+    async def _communicate(self, request, number_of_bytes_to_read):
+        await self._write(request)
+
+        try:
+            # Read and discard local echo
+            if self.handle_local_echo:
+                localEchoToDiscard = await self._read(len(request))
+                if localEchoToDiscard != request:
+                    template = 'Local echo handling is enabled, but the local echo does not match the sent request. ' + \
+                        'Request: {!r} ({} bytes), local echo: {!r} ({} bytes).'
+                    raise IOError(template.format(request, len(request), localEchoToDiscard, len(localEchoToDiscard)))
+
+            answer = await self._readResponse(number_of_bytes_to_read)
+
+        except asyncio.TimeoutError:
+            raise IOError('No communication with the instrument (no answer)')
+
+        finally:
+            self.bus.mark_idle()
+
+        return answer
+
+    async def _readResponse(self, number_of_bytes_to_read):
+        # Read the header first, so an exception response (5 bytes) is not waited out.
+        # Without a predicted size, the byte count field gives the length.
+        answer = await self._read(_RESPONSE_HEADER_SIZE)
+
+        remaining = _remainingResponseSize(answer[1], number_of_bytes_to_read)
+        if remaining is None:
+            answer += await self._read(1)
+            remaining = answer[2] + _NUMBER_OF_CRC_BYTES
+
+        return answer + await self._read(remaining)
+
+    async def _read(self, number_of_bytes):
+        data = await asyncio.wait_for(self.stream.readexactly(number_of_bytes), self.timeout / 1000)
+        return bytearray(data)
+
+
+def _getLock(key):
+    lock = _LOCKS.get(key)
+    if lock is None:
+        lock = asyncio.Lock()
+        _LOCKS[key] = lock
+    return lock
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+# Capture of the Modbus traffic of instruments in a compact binary format, and replay
+# of a capture as a transport, to benchmark parsing and scheduling offline.
+#
+# A capture is a file header followed by fixed-size records, one per transaction:
+#   header: magic b'MMCP', version (B), reserved (B), frame_size (H), little endian
+#   record: time_ms (I), wait_us (I), rtt_ms (H), sent (H), received (H), error (B),
+#           reserved (B), then the request and the response, frame_size bytes each.
+# Frames longer than frame_size are truncated, sent and received keep the real lengths.
+
+import struct
+
+try:
+    import mmap
+except ImportError:
+    mmap = None  # MicroPython, the records are read from the file instead
+
+from minimalmodbus import ERROR_TIMEOUT, ERROR_CRC, ERROR_EXCEPTION, _ticks_ms, _ticks_diff, \
+    _ticks_add, _sleep_ms, _MAX_RTU_FRAME_SIZE
+
+_MAGIC = b'MMCP'
+_VERSION = 1
+_FILE_HEADER_FORMAT = '<4sBBH'
+_FILE_HEADER_SIZE = 8
+_RECORD_HEADER_FORMAT = '<IIHHHBB'
+_RECORD_HEADER_SIZE = 16
+
+_ERROR_CODES = {None: 0, ERROR_TIMEOUT: 1, ERROR_CRC: 2, ERROR_EXCEPTION: 3}
+_ERRORS = (None, ERROR_TIMEOUT, ERROR_CRC, ERROR_EXCEPTION)
+
+
+class TrafficCapture():
+#    """Records each transaction as a fixed-size binary record. Register with Instrument.add_hook().
+
+#    Without a path the records are kept in a ring buffer of ``capacity`` records in RAM, the
+#    oldest are overwritten (counted in ``overwritten``); save() writes them to a file. With a
+#    path every record is appended to that file. The buffers are allocated once, recording a
+#    transaction only copies the frames and packs the record header.
+
+#    Args:
+#        * capacity (int): Number of records of the ring buffer. Not used with a path.
+#        * path (str): File to write the records to, instead of the ring buffer.
+#        * frame_size (int): Bytes kept of each request and response. Smaller saves RAM.
+#    """
+
+    def __init__(self, capacity=32, path=None, frame_size=_MAX_RTU_FRAME_SIZE):
+        if not 1 <= frame_size <= _MAX_RTU_FRAME_SIZE:
+            raise ValueError('The frame_size must be 1 to {}. Given: {!r}'.format(_MAX_RTU_FRAME_SIZE, frame_size))
+        if capacity < 1:
+            raise ValueError('The capacity must be at least 1. Given: {!r}'.format(capacity))
+
+        self.frame_size = frame_size
+        self.record_size = _RECORD_HEADER_SIZE + 2 * frame_size
+        self.path = path
+        self.recorded = 0
+        self.overwritten = 0
+
+        if path is None:
+            self.capacity = capacity
+            self._buffer = bytearray(capacity * self.record_size)
+            self._file = None
+        else:
+            self.capacity = None
+            self._buffer = bytearray(self.record_size)
+            self._file = open(path, 'wb')
+            self._file.write(_fileHeader(frame_size))
+        self._view = memoryview(self._buffer)
+
+    def __repr__(self):
+        return "{}.{}<path={}, capacity={}, frame_size={}, recorded={}, overwritten={}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            self.path,
+            self.capacity,
+            self.frame_size,
+            self.recorded,
+            self.overwritten,
+            )
+
+    def __call__(self, record):
+        if self._file is None:
+            if self.recorded >= self.capacity:
+                self.overwritten += 1
+            offset = (self.recorded % self.capacity) * self.record_size
+        else:
+            offset = 0
+
+        sent = min(record.sent, self.frame_size)
+        received = min(record.received, self.frame_size)
+        struct.pack_into(_RECORD_HEADER_FORMAT, self._buffer, offset,
+            record.time_ms & 0xFFFFFFFF,
+            min(record.wait_us, 0xFFFFFFFF),
+            min(record.rtt_ms, 0xFFFF),
+            record.sent,
+            record.received,
+            _ERROR_CODES[record.error],
+            0)
+
+        start = offset + _RECORD_HEADER_SIZE
+        self._view[start:start + sent] = memoryview(record.request)[0:sent]
+        start += self.frame_size
+        self._view[start:start + received] = memoryview(record.response)[0:received]
+        self.recorded += 1
+
+        if self._file is not None:
+            self._file.write(self._buffer)
+
+    def __len__(self):
+        if self._file is None:
+            return min(self.recorded, self.capacity)
+        return self.recorded
+
+    def save(self, path):
+        # Write the records of the ring buffer to a file, oldest first
+        if self._file is not None:
+            raise ValueError('The capture is written to {} already'.format(self.path))
+        first = self.recorded % self.capacity if self.overwritten else 0
+        split = first * self.record_size
+        used = len(self) * self.record_size
+        with open(path, 'wb') as f:
+            f.write(_fileHeader(self.frame_size))
+            f.write(self._view[split:used])
+            f.write(self._view[0:split])
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ReplayTransport():
+#    """Transport that answers with the responses of a capture, to run an Instrument without hardware.
+
+#    Each written request is answered with the response of the next record, after the
+#    recorded roundtrip time divided by ``speed``: 1 is the original timing, 10 ten times
+#    faster, and None answers at once. Recorded timeouts are replayed as no (or a partial)
+#    response. Requests that differ from the recorded ones are counted in ``mismatches``.
+#    With ``loop`` the capture starts over at the end, otherwise writing raises IOError.
+
+#    On the host the capture file is memory-mapped, and the records are read from the mapping
+#    without copying the file. Local echo is not replayed.
+
+#    Args:
+#        * source: Path of a capture file, or its content (bytes-like).
+#        * speed: Time scale of the responses, or None.
+#        * loop (bool): Restart at the end of the capture.
+#    """
+
+    def __init__(self, source, speed=1, loop=False):
+        self.speed = speed
+        self.loop = loop
+        self._file = None
+        self._map = None
+
+        if isinstance(source, str):
+            self._file = open(source, 'rb')
+            if mmap is not None:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                data = memoryview(self._map)
+            else:
+                data = memoryview(self._file.read())
+        else:
+            data = memoryview(source)
+
+        if len(data) < _FILE_HEADER_SIZE:
+            raise ValueError('Too short for a capture: {} bytes'.format(len(data)))
+        magic, version, _, frame_size = struct.unpack_from(_FILE_HEADER_FORMAT, data, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('Not a capture of version {}: {!r}'.format(_VERSION, bytes(data[0:_FILE_HEADER_SIZE])))
+
+        self.frame_size = frame_size
+        self.record_size = _RECORD_HEADER_SIZE + 2 * frame_size
+        self.count = (len(data) - _FILE_HEADER_SIZE) // self.record_size
+        self.index = 0
+        self.mismatches = 0
+        self._data = data
+        self._response = None  # Memoryview of the pending response
+        self._position = 0
+        self._ready = 0  # Ticks (ms) when the pending response has arrived
+
+    def __repr__(self):
+        return "{}.{}<count={}, index={}, speed={}, mismatches={}>".format(
+            self.__module__, self.__class__.__name__, self.count, self.index, self.speed, self.mismatches)
+
+    def records(self):
+        # The records as (time_ms, wait_us, rtt_ms, error, request, response). The frames are
+        # memoryviews of the capture, truncated to frame_size. Drop them before close().
+        for index in range(self.count):
+            yield self._record(index)
+
+    def write(self, buffer):
+        if self.index >= self.count:
+            if not self.loop or not self.count:
+                raise IOError('The capture is exhausted after {} records'.format(self.count))
+            self.index = 0
+
+        _, _, rtt_ms, _, request, response = self._record(self.index)
+        self.index += 1
+        if bytes(request) != bytes(buffer[0:len(request)]):
+            self.mismatches += 1
+
+        delay = int(rtt_ms / self.speed) if self.speed else 0
+        self._response = response
+        self._position = 0
+        self._ready = _ticks_add(_ticks_ms(), delay)
+        return len(buffer)
+
+    def read(self, nbytes):
+        data = self._take(nbytes)
+        return None if data is None else bytes(data)
+
+    def readinto(self, buffer, nbytes=None):
+        if nbytes is None:
+            nbytes = len(buffer)
+        data = self._take(min(nbytes, len(buffer)))
+        if data is None:
+            return None
+        buffer[0:len(data)] = data
+        return len(data)
+
+    def any(self):
+        if self._response is None or _ticks_diff(_ticks_ms(), self._ready) < 0:
+            return 0
+        return len(self._response) - self._position
+
+    def close(self):
+        self._response = None
+        if self._map is not None:
+            self._data.release()  # The mapping can only be closed without views on it
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._data = None
+
+    def _take(self, nbytes):
+        # Wait for the pending response like a UART read, and take up to nbytes of it
+        if self._response is None or self._position >= len(self._response):
+            return None
+        delay = _ticks_diff(self._ready, _ticks_ms())
+        if delay > 0:
+            _sleep_ms(delay)
+        start = self._position
+        self._position = min(start + nbytes, len(self._response))
+        return self._response[start:self._position]
+
+    def _record(self, index):
+        offset = _FILE_HEADER_SIZE + index * self.record_size
+        time_ms, wait_us, rtt_ms, sent, received, error, _ = struct.unpack_from(_RECORD_HEADER_FORMAT, self._data, offset)
+        start = offset + _RECORD_HEADER_SIZE
+        request = self._data[start:start + min(sent, self.frame_size)]
+        start += self.frame_size
+        response = self._data[start:start + min(received, self.frame_size)]
+        return time_ms, wait_us, rtt_ms, _ERRORS[error], request, response
+
+
+def _fileHeader(frame_size):
+    return struct.pack(_FILE_HEADER_FORMAT, _MAGIC, _VERSION, 0, frame_size)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+# Modbus RTU slave (server), using the framing and CRC of minimalmodbus.
+# The registers and bits live in preallocated banks, and requests and replies
+# are handled in preallocated buffers, so answering does not allocate.
+
+from array import array
+
+from minimalmodbus import _crc16, _numberOfBytesForBits, _checkInt, _sleep_ms, \
+    _BROADCAST_ADDRESS, _MAX_RTU_FRAME_SIZE, _MAX_NUMBER_OF_READ_REGISTERS, _MAX_NUMBER_OF_WRITE_REGISTERS, \
+    _MAX_NUMBER_OF_READ_WRITE_WRITE_REGISTERS, _MAX_NUMBER_OF_READ_BITS, _MAX_NUMBER_OF_WRITE_BITS
+
+# Exception codes
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_ADDRESS = 2
+ILLEGAL_DATA_VALUE = 3
+
+_MINIMAL_REQUEST_SIZE = 4  # Slave address, functioncode and CRC
+_COIL_ON = 0xFF00
+_COIL_OFF = 0x0000
+
+
+class Slave():
+#    """A Modbus RTU slave with banks of holding registers, input registers, coils and discrete inputs.
+
+#    The banks are ``holding_registers`` and ``input_registers`` (array('H')) and ``coils`` and
+#    ``discrete_inputs`` (bytearray, packed: bit i is ``(bank[i // 8] >> (i % 8)) & 1``).
+#    The application updates them in place; addresses start at 0.
+
+#    Functioncodes 1, 2, 3, 4, 5, 6, 15, 16 and 23 are supported. Requests with a bad CRC or for
+#    another slave are ignored, broadcasts (slave address 0) are executed without reply.
+#    ``on_write(functioncode, address, count)`` is called after the master wrote to the banks.
+
+#    Serve a transport with serve_once() from the main loop, or serve(). A Slave can also be
+#    the responder of a LoopbackTransport, to stand in for a device in tests.
+
+#    Args:
+#        * slaveaddress (int): Slave address in the range 1 to 247.
+#        * holding_registers (int): Number of holding registers.
+#        * input_registers (int): Number of input registers.
+#        * coils (int): Number of coils.
+#        * discrete_inputs (int): Number of discrete inputs.
+#    """
+
+    def __init__(self, slaveaddress, holding_registers=0, input_registers=0, coils=0, discrete_inputs=0):
+        _checkInt(slaveaddress, minvalue=1, maxvalue=247, description='slaveaddress')
+        for number, description in ((holding_registers, 'holding_registers'), (input_registers, 'input_registers'), \
+                (coils, 'coils'), (discrete_inputs, 'discrete_inputs')):
+            _checkInt(number, minvalue=0, maxvalue=0x10000, description=description)
+
+        self.address = slaveaddress
+        self.holding_registers = array('H', bytes(2 * holding_registers))
+        self.input_registers = array('H', bytes(2 * input_registers))
+        self.coils = bytearray(_numberOfBytesForBits(coils))
+        self.discrete_inputs = bytearray(_numberOfBytesForBits(discrete_inputs))
+        self.number_of_coils = coils
+        self.number_of_discrete_inputs = discrete_inputs
+        self.on_write = None
+
+        self.requests = 0
+        self.exceptions = 0
+        self.ignored = 0
+
+        self._rxbuf = bytearray(_MAX_RTU_FRAME_SIZE)
+        self._txbuf = bytearray(_MAX_RTU_FRAME_SIZE)
+        self._views = {}  # Reply length -> memoryview of the TX buffer, created once per length
+
+    def __repr__(self):
+        return "{}.{}<address={}, holding_registers={}, input_registers={}, coils={}, discrete_inputs={}, requests={}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            self.address,
+            len(self.holding_registers),
+            len(self.input_registers),
+            self.number_of_coils,
+            self.number_of_discrete_inputs,
+            self.requests,
+            )
+
+    def __call__(self, request):
+        # LoopbackTransport responder: the reply as bytes, None if there is none
+        length = len(request)
+        if length > _MAX_RTU_FRAME_SIZE:
+            self.ignored += 1
+            return None
+        self._rxbuf[0:length] = request
+        size = self.handle(self._rxbuf, length)
+        return bytes(self._txbuf[0:size]) if size else None
+
+    def serve_once(self, transport):
+        # Answer a request if one has arrived. Returns True if a request was read.
+        if not transport.any():
+            return False
+        length = transport.readinto(self._rxbuf) or 0  # Ends at the inter-frame gap
+        size = self.handle(self._rxbuf, length)
+        if size:
+            view = self._views.get(size)
+            if view is None:
+                view = memoryview(self._txbuf)[0:size]
+                self._views[size] = view
+            transport.write(view)
+        return True
+
+    def serve(self, transport, idle_ms=1):
+        # Answer requests forever
+        while True:
+            if not self.serve_once(transport):
+                _sleep_ms(idle_ms)
+
+    def handle(self, request, length):
+        # Handle the request frame request[0:length]. The reply is built in the TX buffer.
+        # Returns its length, 0 if there is no reply.
+        if length < _MINIMAL_REQUEST_SIZE or _crc16(request, 0, length) != 0:
+            self.ignored += 1  # The CRC over a frame including its own CRC is 0
+            return 0
+
+        slaveaddress = request[0]
+        if slaveaddress != self.address and slaveaddress != _BROADCAST_ADDRESS:
+            self.ignored += 1
+            return 0
+        self.requests += 1
+
+        tx = self._txbuf
+        tx[0] = self.address
+        tx[1] = request[1]
+        size = self._execute(request, length, tx)
+
+        if size < 0:
+            tx[1] = request[1] | 0x80
+            tx[2] = -size
+            size = 3
+            self.exceptions += 1
+
+        if slaveaddress == _BROADCAST_ADDRESS:
+            return 0
+
+        crc = _crc16(tx, 0, size)
+        tx[size] = crc & 0xFF
+        tx[size + 1] = crc >> 8
+        return size + 2
+
+    #########################################
+    ## Functioncode implementation details ##
+    #########################################
+
+    def _execute(self, request, length, tx):
+        # Returns the reply size without CRC, or minus the exception code
+        functioncode = request[1]
+        payloadlength = length - 4  # Without address, functioncode and CRC
+        if functioncode not in (1, 2, 3, 4, 5, 6, 15, 16, 23):
+            return -ILLEGAL_FUNCTION
+        if payloadlength < 4:
+            return -ILLEGAL_DATA_VALUE
+
+        address = (request[2] << 8) | request[3]
+        count = (request[4] << 8) | request[5]
+
+        if functioncode in (3, 4):
+            bank = self.holding_registers if functioncode == 3 else self.input_registers
+            if not 1 <= count <= _MAX_NUMBER_OF_READ_REGISTERS:
+                return -ILLEGAL_DATA_VALUE
+            if address + count > len(bank):
+                return -ILLEGAL_DATA_ADDRESS
+            tx[2] = 2 * count
+            _registersToFrame(bank, address, count, tx, 3)
+            return 3 + 2 * count
+
+        if functioncode in (1, 2):
+            if functioncode == 1:
+                bank, size = self.coils, self.number_of_coils
+            else:
+                bank, size = self.discrete_inputs, self.number_of_discrete_inputs
+            if not 1 <= count <= _MAX_NUMBER_OF_READ_BITS:
+                return -ILLEGAL_DATA_VALUE
+            if address + count > size:
+                return -ILLEGAL_DATA_ADDRESS
+            bytecount = _numberOfBytesForBits(count)
+            tx[2] = bytecount
+            tx[2 + bytecount] = 0  # The unused bits of the last byte are 0
+            _copyBits(bank, address, tx, 3 * 8, count)
+            return 3 + bytecount
+
+        if functioncode == 5:
+            value = count
+            if value != _COIL_ON and value != _COIL_OFF:
+                return -ILLEGAL_DATA_VALUE
+            if address >= self.number_of_coils:
+                return -ILLEGAL_DATA_ADDRESS
+            _setBit(self.coils, address, value == _COIL_ON)
+            return self._written(functioncode, address, 1, request, tx)
+
+        if functioncode == 6:
+            if address >= len(self.holding_registers):
+                return -ILLEGAL_DATA_ADDRESS
+            self.holding_registers[address] = count
+            return self._written(functioncode, address, 1, request, tx)
+
+        if functioncode == 15:
+            bytecount = _numberOfBytesForBits(count)
+            if not 1 <= count <= _MAX_NUMBER_OF_WRITE_BITS or payloadlength != 5 + bytecount or \
+                    request[6] != bytecount:
+                return -ILLEGAL_DATA_VALUE
+            if address + count > self.number_of_coils:
+                return -ILLEGAL_DATA_ADDRESS
+            _copyBits(request, 7 * 8, self.coils, address, count)
+            return self._written(functioncode, address, count, request, tx)
+
+        if functioncode == 16:
+            if not 1 <= count <= _MAX_NUMBER_OF_WRITE_REGISTERS or payloadlength != 5 + 2 * count or \
+                    request[6] != 2 * count:
+                return -ILLEGAL_DATA_VALUE
+            if address + count > len(self.holding_registers):
+                return -ILLEGAL_DATA_ADDRESS
+            _registersFromFrame(request, 7, self.holding_registers, address, count)
+            return self._written(functioncode, address, count, request, tx)
+
+        # Functioncode 23: write first, then read
+        if payloadlength < 9:
+            return -ILLEGAL_DATA_VALUE
+        writeaddress = (request[6] << 8) | request[7]
+        writecount = (request[8] << 8) | request[9]
+        bank = self.holding_registers
+        if not 1 <= count <= _MAX_NUMBER_OF_READ_REGISTERS or \
+                not 1 <= writecount <= _MAX_NUMBER_OF_READ_WRITE_WRITE_REGISTERS or \
+                payloadlength != 9 + 2 * writecount or request[10] != 2 * writecount:
+            return -ILLEGAL_DATA_VALUE
+        if address + count > len(bank) or writeaddress + writecount > len(bank):
+            return -ILLEGAL_DATA_ADDRESS
+        _registersFromFrame(request, 11, bank, writeaddress, writecount)
+        if self.on_write is not None:
+            self.on_write(functioncode, writeaddress, writecount)
+        tx[2] = 2 * count
+        _registersToFrame(bank, address, count, tx, 3)
+        return 3 + 2 * count
+
+    def _written(self, functioncode, address, count, request, tx):
+        # The reply to a write repeats the first 6 bytes of the request
+        for i in range(2, 6):
+            tx[i] = request[i]
+        if self.on_write is not None:
+            self.on_write(functioncode, address, count)
+        return 6
+
+
+def _registersToFrame(bank, address, count, buffer, offset):
+    for i in range(count):
+        value = bank[address + i]
+        buffer[offset] = value >> 8
+        buffer[offset + 1] = value & 0xFF
+        offset += 2
+
+
+def _registersFromFrame(buffer, offset, bank, address, count):
+    for i in range(count):
+        bank[address + i] = (buffer[offset] << 8) | buffer[offset + 1]
+        offset += 2
+
+
+def _setBit(bank, bitnumber, value):
+    if value:
+        bank[bitnumber >> 3] |= 1 << (bitnumber & 7)
+    else:
+        bank[bitnumber >> 3] &= ~(1 << (bitnumber & 7)) & 0xFF
+
+
+def _copyBits(source, sourcebit, destination, destinationbit, count):
+    # Copy count packed bits. Whole bytes are copied at once when both sides are byte aligned.
+    if not sourcebit & 7 and not destinationbit & 7:
+        sourcebyte = sourcebit >> 3
+        destinationbyte = destinationbit >> 3
+        wholebytes = count >> 3
+        for i in range(wholebytes):
+            destination[destinationbyte + i] = source[sourcebyte + i]
+        done = wholebytes << 3
+        sourcebit += done
+        destinationbit += done
+        count -= done
+
+    for i in range(count):
+        _setBit(destination, destinationbit + i, (source[(sourcebit + i) >> 3] >> ((sourcebit + i) & 7)) & 1)
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+# Modbus TCP client, using the PDU handling of minimalmodbus.
+# Connections are pooled per endpoint, and several transactions can be in flight
+# on a connection at the same time, matched by the MBAP transaction identifier.
+
+import struct
+
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+
+from minimalmodbus import TIMEOUT, _createPayload, _interpretPayload, \
+    _checkFunctioncode, _checkInt, _checkBool, _checkNumerical, _setBitOn, _crc16, _thread, \
+    _PAYLOADFORMAT_REGISTERS, _MAX_RTU_FRAME_SIZE
+
+####################
+## Default values ##
+####################
+
+PORT = 502
+#"""Default TCP port of Modbus TCP servers (int)."""
+
+MAX_IN_FLIGHT = 8
+#"""Default maximum number of transactions in flight per connection (int)."""
+
+MAX_CONNECTIONS = 2
+#"""Default maximum number of idle connections kept per endpoint (int)."""
+
+_MBAP_HEADER_FORMAT = '>HHHB'  # Transaction id, protocol id, length, unit id
+_MBAP_HEADER_SIZE = 7
+_MODBUS_PROTOCOL_ID = 0
+_MAX_TRANSACTION_ID = 0xFFFF
+
+# Connection pools per (host, port, max_connections, timeout)
+_POOLS = {}
+
+#####################
+## Connection pool ##
+#####################
+
+
+class TcpConnection():
+#    """A Modbus TCP connection. Several requests can be sent before their responses are read."""
+
+    def __init__(self, host, port, timeout):
+        address = socket.getaddrinfo(host, port)[0][-1]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout / 1000)
+        self.sock.connect(address)
+
+        self._transaction_id = 0
+        self._responses = {}  # transaction id -> (unit id, pdu), for responses that arrived out of order
+
+    def __repr__(self):
+        return "{}.{}<sock={!r}, in_flight={}>".format(
+            self.__module__, self.__class__.__name__, self.sock, len(self._responses))
+
+    def send(self, slaveaddress, pdu):
+        # Send a request, returns its transaction id
+        self._transaction_id = (self._transaction_id + 1) & _MAX_TRANSACTION_ID
+        header = struct.pack(_MBAP_HEADER_FORMAT, self._transaction_id, _MODBUS_PROTOCOL_ID, len(pdu) + 1, slaveaddress)
+        self.sock.sendall(header + pdu)
+        return self._transaction_id
+
+    def receive(self, transaction_id):
+        # Returns (unit id, pdu) of the response to the given transaction
+        while transaction_id not in self._responses:
+            header = self._receiveExactly(_MBAP_HEADER_SIZE)
+            received_id, protocol_id, length, unit = struct.unpack(_MBAP_HEADER_FORMAT, header)
+            if protocol_id != _MODBUS_PROTOCOL_ID:
+                raise ValueError('Wrong protocol identifier in the MBAP header: {}. The header is: {!r}'.format( \
+                    protocol_id, header))
+            self._responses[received_id] = (unit, self._receiveExactly(length - 1))
+
+        return self._responses.pop(transaction_id)
+
+    def close(self):
+        self.sock.close()
+
+    def _receiveExactly(self, number_of_bytes):
+        return _receiveExactly(self.sock, number_of_bytes)
+
+
+class TcpConnectionPool():
+#    """Reuses connections to one Modbus TCP endpoint. At most max_connections idle connections are kept."""
+
+    def __init__(self, host, port=PORT, max_connections=MAX_CONNECTIONS, timeout=TIMEOUT):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.opened = 0
+        self._idle = []
+
+    def __repr__(self):
+        return "{}.{}<host={}, port={}, idle={}, opened={}>".format(
+            self.__module__, self.__class__.__name__, self.host, self.port, len(self._idle), self.opened)
+
+    def acquire(self):
+        if self._idle:
+            return self._idle.pop()
+        self.opened += 1
+        return TcpConnection(self.host, self.port, self.timeout)
+
+    def release(self, connection, broken=False):
+        # A broken connection (error, or unread responses) is closed instead of reused
+        if broken or len(self._idle) >= self.max_connections:
+            connection.close()
+        else:
+            self._idle.append(connection)
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
+
+
+def _getPool(host, port, max_connections, timeout):
+    # Instruments with another timeout or max_connections get a pool of their own
+    key = (host, port, max_connections, timeout)
+    pool = _POOLS.get(key)
+    if pool is None:
+        pool = TcpConnectionPool(host, port, max_connections, timeout)
+        _POOLS[key] = pool
+    return pool
+
+##################################
+## Modbus TCP instrument object ##
+##################################
+
+
+class TcpInstrument():
+#    """Instrument class for talking to a slave via Modbus TCP.
+
+#    Args:
+#        * host (str): Host name or IP address of the Modbus TCP server or gateway.
+#        * slaveaddress (int): Unit identifier in the range 0 to 255.
+#        * port (int): TCP port.
+#        * timeout (int): Socket timeout in ms.
+#        * max_in_flight (int): Maximum number of pipelined transactions per connection.
+#        * max_connections (int): Maximum number of idle connections kept for the endpoint.
+#    """
+
+    def __init__(self, host, slaveaddress, port=PORT, timeout=TIMEOUT, \
+            max_in_flight=MAX_IN_FLIGHT, max_connections=MAX_CONNECTIONS):
+        _checkInt(slaveaddress, minvalue=0, maxvalue=0xFF, description='unit identifier')
+        _checkInt(max_in_flight, minvalue=1, description='max_in_flight')
+        _checkInt(max_connections, minvalue=1, description='max_connections')
+
+        self.host = host
+        self.port = port
+        self.address = slaveaddress
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.pool = _getPool(host, port, max_connections, timeout)
+
+    def __repr__(self):
+        return "{}.{}<id=0x{:x}, host={}, port={}, address={}, max_in_flight={}>".format(
+            self.__module__,
+            self.__class__.__name__,
+            id(self),
+            self.host,
+            self.port,
+            self.address,
+            self.max_in_flight,
+            )
+
+    ######################################
+    ## Methods for talking to the slave ##
+    ######################################
+
+    def write_register(self, registeraddress, value, signed=False):
+        _checkBool(signed, description='signed')
+        _checkNumerical(value, description='input value')
+
+        self._genericCommand(6, registeraddress, value, signed=signed)
+
+    def read_registers(self, registeraddress, numberOfRegisters, functioncode=3):
+        _checkFunctioncode(functioncode, [3, 4])
+        _checkInt(numberOfRegisters, minvalue=1, description='number of registers')
+        return self._genericCommand(functioncode, registeraddress, \
+            numberOfRegisters=numberOfRegisters, payloadformat=_PAYLOADFORMAT_REGISTERS)
+
+    def read_registers_many(self, requests):
+        # Pipelined reads. requests is a list of (registeraddress, numberOfRegisters) or
+        # (registeraddress, numberOfRegisters, functioncode). Returns a list of value lists.
+        commands = []
+        for request in requests:
+            functioncode = request[2] if len(request) > 2 else 3
+            _checkFunctioncode(functioncode, [3, 4])
+            commands.append((functioncode, request[0], None, request[1], False, _PAYLOADFORMAT_REGISTERS))
+        return self._genericCommands(commands)
+
+    def write_registers(self, registeraddress, values, signed=False):
+        _checkInt(len(values), minvalue=1, description='length of input list')
+
+        self._genericCommand(16, registeraddress, values, numberOfRegisters=len(values), signed=signed, \
+            payloadformat=_PAYLOADFORMAT_REGISTERS)
+
+    ##########################################
+    ## Communication implementation details ##
+    ##########################################
+
+    def _genericCommand(self, functioncode, registeraddress, value=None, \
+            numberOfRegisters=1, signed=False, payloadformat=None):
+        return self._genericCommands([(functioncode, registeraddress, value, \
+            numberOfRegisters, signed, payloadformat)])[0]
+
+    def _genericCommands(self, commands):
+        # commands is a list of _createPayload() arguments
+        requests = []
+        for command in commands:
+            payloadToSlave, payloadformat = _createPayload(*command)
+            requests.append((command[0], payloadToSlave, payloadformat))
+
+        payloadsFromSlave = self._performCommands(requests)
+
+        results = []
+        for i in range(len(commands)):
+            functioncode, registeraddress, value, numberOfRegisters, signed = commands[i][0:5]
+            results.append(_interpretPayload(functioncode, registeraddress, value, \
+                numberOfRegisters, signed, requests[i][2], payloadsFromSlave[i]))
+        return results
+
+    def _performCommands(self, requests):
+        # Send the requests with at most max_in_flight outstanding on one connection.
+        # Returns the response payloads, in the order of the requests.
+        # An exception response (ValueError) leaves the connection usable: no more requests
+        # are sent, the responses in flight are read, and then the error is raised.
+        connection = self.pool.acquire()
+        payloadsFromSlave = [None] * len(requests)
+        in_flight = []  # (request index, transaction id)
+        number_sent = 0
+        slave_error = None
+
+        try:
+            while number_sent < len(requests) or in_flight:
+                while slave_error is None and number_sent < len(requests) and len(in_flight) < self.max_in_flight:
+                    pdu = bytearray([requests[number_sent][0]]) + requests[number_sent][1]
+                    in_flight.append((number_sent, connection.send(self.address, pdu)))
+                    number_sent += 1
+                if not in_flight:
+                    break
+
+                index, transaction_id = in_flight.pop(0)
+                unit, pdu = connection.receive(transaction_id)
+                try:
+                    payloadsFromSlave[index] = _extractPdu(pdu, unit, self.address, requests[index][0])
+                except ValueError as error:
+                    if slave_error is None:
+                        slave_error = error
+
+        except OSError as error:
+            self.pool.release(connection, broken=True)
+            raise IOError('No communication with the instrument ({})'.format(error))
+
+        except:
+            self.pool.release(connection, broken=True)
+            raise
+
+        self.pool.release(connection)
+        if slave_error is not None:
+            raise slave_error
+        return payloadsFromSlave
+
+
+def _extractPdu(pdu, unit, slaveaddress, functioncode):
+    BITNUMBER_FUNCTIONCODE_ERRORINDICATION = 7
+
+    if len(pdu) < 1:
+        raise ValueError('Too short Modbus TCP response. Response PDU: {!r}'.format(pdu))
+
+    if unit != slaveaddress:
+        raise ValueError('Wrong return unit identifier: {} instead of {}. The response PDU is: {!r}'.format( \
+            unit, slaveaddress, pdu))
+
+    receivedFunctioncode = pdu[0]
+    if receivedFunctioncode == _setBitOn(functioncode, BITNUMBER_FUNCTIONCODE_ERRORINDICATION):
+        raise ValueError('The slave is indicating an error. The response PDU is: {!r}'.format(pdu))
+
+    elif receivedFunctioncode != functioncode:
+        raise ValueError('Wrong functioncode: {} instead of {}. The response PDU is: {!r}'.format( \
+            receivedFunctioncode, functioncode, pdu))
+
+    return bytearray(pdu[1:])
+
+
+def _receiveExactly(sock, number_of_bytes):
+    data = b''
+    while len(data) < number_of_bytes:
+        chunk = sock.recv(number_of_bytes - len(data))
+        if not chunk:
+            raise IOError('The Modbus TCP connection was closed by the peer')
+        data += chunk
+    return data
+
+#######################
+## Modbus TCP server ##
+#######################
+
+
+class TcpServer():
+#    """Modbus TCP server for a minimalmodbus_slave.Slave, for example a stand-in device to test
+#    TcpInstrument against, on the loopback interface.
+
+#    The PDU of each request is handed to the Slave in an RTU frame, and its reply is sent
+#    back with the MBAP header of the request. Requests the Slave does not answer (another
+#    unit identifier, broadcast) get no response. Each connection is served in its own thread
+#    if _thread is available, otherwise one after the other.
+
+#    Args:
+#        * slave: The minimalmodbus_slave.Slave that answers the requests.
+#        * host (str): Address to listen on.
+#        * port (int): TCP port to listen on. With 0 a free port is chosen, see ``port``.
+#    """
+
+    ACCEPT_TIMEOUT = 0.1  # Check for close() at least this often (s)
+
+    def __init__(self, slave, host='0.0.0.0', port=PORT):
+        self.slave = slave
+        self.requests = 0
+        self._closed = False
+        self._lock = _thread.allocate_lock() if _thread is not None else None  # The Slave has one TX buffer
+
+        address = socket.getaddrinfo(host, port)[0][-1]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(MAX_CONNECTIONS + 2)
+        self.sock.settimeout(self.ACCEPT_TIMEOUT)
+        self.port = self.sock.getsockname()[1] if port == 0 else port
+
+    def __repr__(self):
+        return "{}.{}<port={}, slave={!r}, requests={}>".format(
+            self.__module__, self.__class__.__name__, self.port, self.slave, self.requests)
+
+    def serve(self):
+        # Accept and serve connections until close()
+        while not self._closed:
+            try:
+                connection = self.sock.accept()[0]
+            except OSError:  # Accept timeout, or closed
+                continue
+            connection.settimeout(None)
+            if _thread is not None:
+                _thread.start_new_thread(self._serveConnection, (connection,))
+            else:
+                self._serveConnection(connection)
+
+    def close(self):
+        self._closed = True
+        self.sock.close()
+
+    def _serveConnection(self, connection):
+        frame = bytearray(_MAX_RTU_FRAME_SIZE)
+        try:
+            while not self._closed:
+                header = _receiveExactly(connection, _MBAP_HEADER_SIZE)
+                transaction_id, protocol_id, length, unit = struct.unpack(_MBAP_HEADER_FORMAT, header)
+                if protocol_id != _MODBUS_PROTOCOL_ID or not 2 <= length <= _MAX_RTU_FRAME_SIZE - 2:
+                    return  # Not Modbus, the stream cannot be trusted any more
+
+                # Unit identifier, PDU and CRC, as the Slave expects an RTU frame
+                frame[0] = unit
+                frame[1:length] = _receiveExactly(connection, length - 1)
+                crc = _crc16(frame, 0, length)
+                frame[length] = crc & 0xFF
+                frame[length + 1] = crc >> 8
+
+                if self._lock is not None:
+                    self._lock.acquire()
+                try:
+                    self.requests += 1
+                    size = self.slave.handle(frame, length + 2)
+                    pdu = bytes(self.slave._txbuf[1:size - 2]) if size else None
+                finally:
+                    if self._lock is not None:
+                        self._lock.release()
+
+                if pdu is not None:
+                    connection.sendall(struct.pack(_MBAP_HEADER_FORMAT, transaction_id, _MODBUS_PROTOCOL_ID, \
+                        len(pdu) + 1, unit) + pdu)
+        except OSError:  # Closed by the client
+            pass
+        finally:
+            connection.close()